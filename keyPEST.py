@@ -2,25 +2,111 @@
 # Mike Fienen --> mnfienen@usgs.gov
 # Jeremy White --> jtwhite@usgs.gov
 import sys
-import numpy as np
+import os
+import glob
+import argparse
 import keyPESTdata as kp
-reload(kp)
-# get the input filename from the command line
-infile  = sys.argv[1]
-if infile[-4:] != '.kyp':
-    raise(InvalidInputExtension(infile))
-else:
-    casename = infile[:-4]
-    
-# initialize the main control
-main_control = kp.file_control()
+# get the input filename(s) and options from the command line
+parser = argparse.ArgumentParser(description='keyPEST --- a JUPITER-like keyword to PST/XML translator')
+parser.add_argument('infile',nargs='*',
+                    help='input control file(s) of format <casename>.kyp, or <casename>.pst to convert to XML, '+
+                         'optionally compressed (.kyp.gz, .bz2 or .xz); quoted wildcards are expanded')
+parser.add_argument('--list',metavar='FILE',
+                    help='file listing input control files, one per line, to convert in batch')
+parser.add_argument('--jobs',type=int,default=1,
+                    help='files converted at once in batch mode (default %(default)s)')
+parser.add_argument('--stream',action='store_true',
+                    help='stream external FILE table blocks into the output instead of reading them into memory')
+parser.add_argument('--chunksize',type=int,default=kp.TABLE_CHUNK,
+                    help='rows per chunk when reading external table files or splitting tables across workers (default %(default)s)')
+parser.add_argument('--workers',type=int,default=1,
+                    help='worker processes for parsing large table blocks (default %(default)s)')
+parser.add_argument('--cache',default=os.environ.get('KEYPEST_CACHE'),metavar='DIR',
+                    help='directory for caching parsed blocks between runs (default $KEYPEST_CACHE)')
+parser.add_argument('--cachesize',type=int,default=kp.CACHE_SIZE,
+                    help='size limit of the cache directory in bytes (default %(default)s)')
+parser.add_argument('--nocache',action='store_true',
+                    help='parse every block from scratch, ignoring --cache')
+parser.add_argument('--lazy',action='store_true',
+                    help='parse the rows of a table block only when they are first needed')
+parser.add_argument('--compress',choices=['gz','bz2','xz'],
+                    help='compress the output files, adding this extension to their names')
+parser.add_argument('--watch',action='store_true',
+                    help='stay running and convert the input file again whenever it, its external files or key_defaults.txt change')
+parser.add_argument('--interval',type=float,default=1.0,
+                    help='seconds between checks for changes in watch mode (default %(default)s)')
+parser.add_argument('--profile',action='store_true',
+                    help='print the time and peak memory of each stage and the rows of each table block')
+args = parser.parse_args()
+if args.nocache:
+    args.cache = None
+outtypes = ('pst','xml')
+if args.compress:
+    outtypes = tuple([ext+'.'+args.compress for ext in outtypes])
+options = dict(stream_files=args.stream,chunksize=args.chunksize,nworkers=args.workers,
+               cachedir=args.cache,cachesize=args.cachesize,profile=args.profile,
+               lazy=args.lazy)
+
+# expand wildcards (not every shell does) and read the list file
+infiles = list()
+for pattern in args.infile:
+    matches = sorted(glob.glob(pattern))
+    if len(matches) > 0:
+        infiles.extend(matches)
+    else:
+        infiles.append(pattern)
+if args.list:
+    for line in open(args.list,'r'):
+        line = line.strip()
+        if len(line) > 0 and not line.startswith('#'):
+            infiles.append(line)
+if len(infiles) == 0:
+    parser.error('no input control files given')
+
+if args.watch:
+    if len(infiles) != 1 or args.list:
+        parser.error('--watch takes a single input control file')
+    # keep the parsed blocks in memory instead of in the cache directory
+    del options['cachedir']
+    try:
+        kp.watch_file(infiles[0],outtypes,args.interval,**options)
+    except KeyboardInterrupt:
+        pass
+elif len(infiles) == 1 and not args.list:
+    infile = infiles[0]
+    if kp.control_format(infile) not in ('kyp','pst'):
+        raise(kp.InvalidInputExtension(infile))
+    else:
+        casename = kp.case_name(infile)
 
-# read, check, and parse the input file
-main_control.read(casename+'.kyp')
+    # initialize the main control
+    main_control = kp.file_control(**options)
 
+    # read, check, and parse the input file
+    main_control.read(infile)
 
-# write the output file in PST form
-main_control.write(casename+'.pst')
 
-# write the output file in XML form
-main_control.write(casename+'.xml')
+    # write the output files in PST form, unless it was the input, and in XML
+    # form, at the same time where there is more than one cpu
+    if kp.control_format(infile) != 'pst':
+        main_control.write_many([casename+'.'+ext for ext in outtypes])
+    else:
+        main_control.write(casename+'.'+outtypes[1])
+
+    if args.profile:
+        print '\n' + main_control.profiler.summary()
+else:
+    # batch mode: convert every file, then summarize
+    results = kp.convert_files(infiles,outtypes,args.jobs,**options)
+    nfailed = len([r for r in results if r[1] is not None])
+    print '\nkeyPEST: %d of %d files converted' % (len(results)-nfailed,len(results))
+    for fname,error,seconds in results:
+        if error is None:
+            print '  ok      %s (%.1f s)' % (fname,seconds)
+        else:
+            print '  FAILED  %s' % fname
+            for line in error.splitlines():
+                if len(line.strip()) > 0:
+                    print '          ' + line
+    if nfailed > 0:
+        sys.exit(1)
@@ -0,0 +1,322 @@
+#keyPESTbench --- scaling benchmarks for the keyPEST read/write pipeline
+# writes synthetic .kyp control files of the requested sizes, times each phase
+# of the conversion in a fresh process and reports the results as JSON
+#   python keyPESTbench.py --nobs 1000 10000 100000 --files obs --out bench.json
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+import resource
+
+# rows written per block of generated lines
+GEN_CHUNK = 100000
+
+# ############################################### #
+# Function to write a synthetic .kyp control file #
+# ############################################### #
+def write_kyp(fname,npar,nobs,npargp=1,nobsgp=1,nprior=0,ntied=0,files=()):
+    '''write a .kyp file with npar parameters in npargp groups, nobs observations
+    in nobsgp groups, nprior prior information equations and ntied tied parameters
+    files lists the blocks ('par', 'obs') written as external FILE blocks next to fname
+    '''
+    casedir = os.path.dirname(os.path.abspath(fname))
+    casename = os.path.splitext(os.path.basename(fname))[0]
+    ofp = open(fname,'w')
+    ofp.write('# synthetic control file written by keyPESTbench.py\n' +
+              'BEGIN control_data KEYWORDS\n' +
+              '  RSTFLE = restart PESTMODE = estimation\n' +
+              '  NPAR = %d NOBS = %d NPARGP = %d NPRIOR = %d NOBSGP = %d\n' % (npar,nobs,npargp,nprior,nobsgp) +
+              '  RLAMBDA1 = 10.0 RLAMFAC = -3.0 PHIRATSUF = 0.3 PHIREDLAM = 0.03\n' +
+              '  RELPARMAX = 10.0 FACPARMAX = 10.0 FACORIG = 0.001\n' +
+              '  PHIREDSWH = 0.1\n' +
+              '  NOPTMAX = 0 PHIREDSTP = 0.005 NPHISTP = 4 NPHINORED = 4 RELPARSTP = 0.005 NRELPAR = 4\n' +
+              'END control_data\n\n' +
+              'BEGIN singular_value_decomposition KEYWORDS\n' +
+              '  SVDMODE = 1 MAXSING = %d EIGTHRESH = 5e-7 EIGWRITE = 0\n' % npar +
+              'END singular_value_decomposition\n\n')
+    write_table(ofp,'parameter_groups',
+                ['PARGPNME','INCTYP','DERINC','DERINCLB','FORCEN','DERINCMUL','DERMTHD'],
+                ('pg%d relative 0.01 0.0001 switch 2.0 parabolic' % j for j in xrange(npargp)),npargp)
+    # the first ntied parameters are tied to the last one
+    partrans = lambda j: 'tied' if j < ntied else 'log'
+    rows = ('par%d %s factor %.6e 1e-10 1e10 pg%d 1.0 0.0 1' % (j,partrans(j),1.0+j%97,j%npargp)
+            for j in xrange(npar))
+    labels = ['PARNME','PARTRANS','PARCHGLIM','PARVAL1','PARLBND','PARUBND','PARGP','SCALE','OFFSET','DERCOM']
+    if 'par' in files:
+        write_table_file(ofp,os.path.join(casedir,casename+'_par.dat'),'parameter_data',labels,rows,npar)
+    else:
+        write_table(ofp,'parameter_data',labels,rows,npar)
+    if ntied > 0:
+        write_table(ofp,'parameter_tied_data',['PARNME','PARTIED'],
+                    ('par%d par%d' % (j,npar-1) for j in xrange(ntied)),ntied)
+    write_table(ofp,'observation_groups',['OBGNME'],('og%d' % j for j in xrange(nobsgp)),nobsgp)
+    rows = ('ob%d %.8e %.4e og%d' % (j,0.001*j,1.0+j%5,j%nobsgp) for j in xrange(nobs))
+    labels = ['OBSNME','OBSVAL','WEIGHT','OBGNME']
+    if 'obs' in files:
+        write_table_file(ofp,os.path.join(casedir,casename+'_obs.dat'),'observation_data',labels,rows,nobs)
+    else:
+        write_table(ofp,'observation_data',labels,rows,nobs)
+    write_table(ofp,'model_command_line',['COMLINE'],['model.bat'],1)
+    write_table(ofp,'model_input',['TEMPFLE','INFLE'],['model.tpl model.in'],1)
+    write_table(ofp,'model_output',['INSFLE','OUTFLE'],['model.ins model.out'],1)
+    if nprior > 0:
+        write_table(ofp,'prior_information',['PILINES'],
+                    ('pi%d 1.0 * log(par%d) = %.6e 1.0 og0' % (j,(npar-1-j)%npar,1.0+j%97) for j in xrange(nprior)),
+                    nprior)
+    ofp.write('BEGIN pest++ KEYWORDS\n' +
+              '  HOST = 127.0.0.1 PORT = 4040 SUPER_NMAX = 100 N_ITER_BASE = 1 N_ITER_SUPER = 4\n' +
+              'END pest++\n')
+    ofp.close()
+
+def write_rows(ofp,rows):
+    chunk = list()
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == GEN_CHUNK:
+            ofp.write('\n'.join(chunk) + '\n')
+            chunk = list()
+    if len(chunk) > 0:
+        ofp.write('\n'.join(chunk) + '\n')
+
+def write_table(ofp,blockname,labels,rows,nrow):
+    ofp.write('BEGIN %s TABLE\nnrow=%d ncol=%d columnlabels\n%s\n' % (blockname,nrow,len(labels),' '.join(labels)))
+    write_rows(ofp,rows)
+    ofp.write('END %s\n\n' % blockname)
+
+def write_table_file(ofp,extfile,blockname,labels,rows,nrow):
+    efp = open(extfile,'w')
+    efp.write('nrow=%d ncol=%d columnlabels\n%s\n' % (nrow,len(labels),' '.join(labels)))
+    write_rows(efp,rows)
+    efp.close()
+    ofp.write('BEGIN %s FILE\n%s\nEND %s\n\n' % (blockname,os.path.basename(extfile),blockname))
+
+# ##################################################### #
+# Function to time each phase of a conversion of a .kyp #
+# ##################################################### #
+def peak_mb():
+    '''peak resident memory of this process so far, in MB'''
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac os x
+    if sys.platform == 'darwin':
+        return maxrss / 1048576.0
+    return maxrss / 1024.0
+
+def run_case(fname,options):
+    '''convert fname phase by phase in this process and return the seconds and
+    the peak memory after each phase; run it in a fresh process so the peak
+    memory belongs to this case alone
+    '''
+    import keyPESTdata as kp
+    casename = fname[:-4]
+    phases = list()
+    def timed(name,func,*args):
+        t0 = time.time()
+        try:
+            func(*args)
+        except Exception as e:
+            # reported with the phase; the other phases still run
+            phases.append({'phase' : name,
+                           'error' : e.__class__.__name__ + ': ' + str(e).strip()})
+            return
+        phases.append({'phase' : name,
+                       'seconds' : time.time() - t0,
+                       'peak_mb' : peak_mb()})
+    fc = kp.file_control(**options)
+    fp = open(fname,'r')
+    timed('integrity',fc.key_check_block_integrity,fp)
+    fp.close()
+    timed('block_init',lambda: (fc.key_initialize_blocks(),fc.default_updates()))
+    timed('keyword_read',fc.key_read_keyword_blocks)
+    timed('table_read',fc.key_read_table_blocks)
+    if fc.validate:
+        timed('validate',lambda: (fc.check_unique_names(),fc.check_references(),fc.key_check_values()))
+    timed('enumeration',fc.key_default_enumeration)
+    timed('pst_write',fc.pst_write,casename+'.pst')
+    timed('xml_write',fc.xml_write,casename+'.xml')
+    # drop the blocks before reading them back
+    fc = None
+    fc = kp.file_control(**options)
+    timed('xml_read',fc.xml_read,casename+'.xml')
+    fc = None
+    fc = kp.file_control(**options)
+    timed('pst_read',fc.pst_read,casename+'.pst')
+    # the PST written back from pst_read must match the first one byte for byte
+    def roundtrip():
+        fc.pst_write(casename+'_rt.pst')
+        if open(casename+'.pst','rb').read() != open(casename+'_rt.pst','rb').read():
+            raise ValueError('%s_rt.pst differs from %s.pst' % (casename,casename))
+    timed('pst_roundtrip',roundtrip)
+    return phases
+
+# ################################################### #
+# Function to run one benchmark case in a new process #
+# ################################################### #
+def bench_case(case,workdir,options):
+    '''write the control file for case, run it in a child process and return the
+    case with its phases and sizes added
+    '''
+    fname = os.path.join(workdir,'bench_%d_%d.kyp' % (case['npar'],case['nobs']))
+    t0 = time.time()
+    write_kyp(fname,**case)
+    result = dict(case)
+    result['files'] = list(case['files'])
+    result['generate_seconds'] = time.time() - t0
+    cmd = [sys.executable,os.path.abspath(__file__),'--run-case',os.path.basename(fname),
+           '--options',json.dumps(options)]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.abspath(__file__)) + os.pathsep + env.get('PYTHONPATH','')
+    child = subprocess.Popen(cmd,cwd=workdir,env=env,stdout=subprocess.PIPE)
+    out = child.communicate()[0]
+    if child.returncode != 0:
+        result['error'] = 'benchmark process failed with exit code %d' % child.returncode
+        return result
+    # the phases are on the last line, after anything keyPEST printed
+    result['phases'] = json.loads(out.strip().splitlines()[-1])
+    result['total_seconds'] = sum([p.get('seconds',0.0) for p in result['phases']])
+    result['peak_mb'] = max([p.get('peak_mb',0.0) for p in result['phases']])
+    result['bytes'] = dict()
+    for ext in ('kyp','pst','xml'):
+        result['bytes'][ext] = os.path.getsize(fname[:-3] + ext)
+    return result
+
+# ######################################################## #
+# Function to time the start of keyPEST in fresh processes #
+# ######################################################## #
+def bench_startup(workdir,nrepeat,srcdir):
+    '''time importing keyPESTdata, keyPEST.py --help and the conversion of a
+    small control file, each nrepeat times in a new interpreter, using the
+    keyPEST files in srcdir; returns the fastest and median seconds of each
+    '''
+    fname = os.path.join(workdir,'startup.kyp')
+    write_kyp(fname,10,10)
+    script = os.path.join(os.path.abspath(srcdir),'keyPEST.py')
+    commands = [('import',[sys.executable,'-c','import keyPESTdata']),
+                ('help',[sys.executable,script,'--help']),
+                ('convert',[sys.executable,script,os.path.basename(fname)])]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.abspath(srcdir) + os.pathsep + env.get('PYTHONPATH','')
+    devnull = open(os.devnull,'w')
+    results = list()
+    try:
+        for name,cmd in commands:
+            times = list()
+            for i in xrange(nrepeat):
+                t0 = time.time()
+                returncode = subprocess.call(cmd,cwd=workdir,env=env,stdout=devnull)
+                times.append(time.time() - t0)
+                if returncode != 0:
+                    results.append({'command' : name,
+                                    'error' : 'exit code %d' % returncode})
+                    break
+            else:
+                times.sort()
+                results.append({'command' : name,
+                                'min_seconds' : times[0],
+                                'median_seconds' : times[len(times)//2]})
+    finally:
+        devnull.close()
+    return results
+
+def print_summary(results,ofp=sys.stderr):
+    for r in results:
+        ofp.write('\nNPAR %d NOBS %d NPRIOR %d FILE blocks: %s\n' %
+                  (r['npar'],r['nobs'],r['nprior'],', '.join(r['files']) or 'none'))
+        if 'error' in r:
+            ofp.write('  ' + r['error'] + '\n')
+            continue
+        for p in r['phases']:
+            if 'error' in p:
+                ofp.write('  %-14s FAILED %s\n' % (p['phase'],p['error'].splitlines()[-1]))
+            else:
+                ofp.write('  %-14s %10.3f s %10.1f MB\n' % (p['phase'],p['seconds'],p['peak_mb']))
+        ofp.write('  %-14s %10.3f s %10.1f MB\n' % ('total',r['total_seconds'],r['peak_mb']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='keyPESTbench --- scaling benchmarks for the keyPEST read/write pipeline')
+    parser.add_argument('--nobs',type=int,nargs='+',default=[1000,10000,100000],
+                        help='numbers of observations, one case each (default %(default)s)')
+    parser.add_argument('--npar',type=int,nargs='+',default=[100],
+                        help='numbers of parameters, one case for each NOBS and NPAR (default %(default)s)')
+    parser.add_argument('--npargp',type=int,default=10,help='parameter groups (default %(default)s)')
+    parser.add_argument('--nobsgp',type=int,default=10,help='observation groups (default %(default)s)')
+    parser.add_argument('--nprior',type=int,default=0,help='prior information equations (default %(default)s)')
+    parser.add_argument('--ntied',type=int,default=0,help='tied parameters (default %(default)s)')
+    parser.add_argument('--files',nargs='*',choices=['par','obs'],default=[],
+                        help='write parameter and/or observation data as external FILE blocks')
+    parser.add_argument('--stream',action='store_true',help='stream external FILE table blocks')
+    parser.add_argument('--workers',type=int,default=1,help='worker processes for parsing large table blocks')
+    parser.add_argument('--novalidate',action='store_true',help='skip the name and value checks')
+    parser.add_argument('--lazy',action='store_true',help='parse table block rows on first use')
+    parser.add_argument('--startup',type=int,default=0,metavar='N',
+                        help='instead of the cases, time the start of keyPEST N times in new processes')
+    parser.add_argument('--srcdir',default=os.path.dirname(os.path.abspath(__file__)),
+                        help='directory of the keyPEST files to time with --startup (default this one)')
+    parser.add_argument('--workdir',help='directory for the generated files (default a temporary directory, removed afterwards)')
+    parser.add_argument('--out',help='file for the JSON results (default standard output)')
+    parser.add_argument('--run-case',help=argparse.SUPPRESS)
+    parser.add_argument('--options',help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # child process: convert one control file and print its phases
+    if args.run_case:
+        phases = run_case(args.run_case,json.loads(args.options))
+        sys.stdout.write('\n' + json.dumps(phases) + '\n')
+        return 0
+
+    options = dict(stream_files=args.stream,nworkers=args.workers,validate=not args.novalidate,
+                   lazy=args.lazy)
+    if args.workdir:
+        workdir = args.workdir
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix='keyPESTbench')
+    results = list()
+    try:
+        if args.startup > 0:
+            startup = bench_startup(workdir,args.startup,args.srcdir)
+            for r in startup:
+                if 'error' in r:
+                    sys.stderr.write('%-8s FAILED %s\n' % (r['command'],r['error']))
+                else:
+                    sys.stderr.write('%-8s %8.3f s fastest %8.3f s median\n' %
+                                     (r['command'],r['min_seconds'],r['median_seconds']))
+            args.npar = []
+        for npar in args.npar:
+            for nobs in args.nobs:
+                case = dict(npar=npar,nobs=nobs,npargp=min(args.npargp,npar),nobsgp=min(args.nobsgp,nobs),
+                            nprior=min(args.nprior,npar),ntied=min(args.ntied,npar-1),files=tuple(args.files))
+                results.append(bench_case(case,workdir,options))
+                print_summary(results[-1:])
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir,ignore_errors=True)
+    import numpy as np
+    report = {'python' : platform.python_version(),
+              'numpy' : np.__version__,
+              'platform' : platform.platform(),
+              'options' : options,
+              'cases' : results}
+    if args.startup > 0:
+        report['srcdir'] = os.path.abspath(args.srcdir)
+        report['startup'] = startup
+    if args.out:
+        ofp = open(args.out,'w')
+    else:
+        ofp = sys.stdout
+    json.dump(report,ofp,indent=1,sort_keys=True)
+    ofp.write('\n')
+    if args.out:
+        ofp.close()
+    if args.startup > 0:
+        return len([r for r in startup if 'error' in r])
+    return len([r for r in results if 'error' in r or
+                [p for p in r['phases'] if 'error' in p]])
+
+if __name__ == '__main__':
+    sys.exit(main())
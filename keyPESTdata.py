@@ -1,8 +1,18 @@
 import sys
 import copy
 import os
-import xml.etree.ElementTree as xml
-import numpy as np
+import time
+import mmap
+import hashlib
+import cPickle
+import ast
+import re
+import string
+from cStringIO import StringIO
+import array
+from itertools import izip, imap
+# numpy, xml.etree and collections are imported by the functions that need
+# them, so that starting keyPEST does not pay for them up front
 
 
 
@@ -11,6 +21,13 @@ UNINIT_STRING = 'unititialized'
 UNINIT_REAL   = '-9.9999e25'
 UNINIT_INT    = '-99999'
 UNINIT = [UNINIT_STRING,UNINIT_REAL,UNINIT_INT]
+WRITE_CHUNK = 100000  # rows formatted per buffered write of a table block
+TABLE_CHUNK = 100000  # rows parsed at a time when streaming external table files
+CACHE_VERSION = '2' # bump when the parsed block representation changes
+CACHE_SIZE = 2**30   # default size limit of the block cache directory in bytes
+SNAPSHOT_VERSION = 1 # bump when the snapshot layout changes
+PST_BATCH = 2**20   # bytes of a PST file read at a time
+NUMSTART = frozenset('0123456789+-. \t\n\r\f\viInN') # possible first characters of a number
 
 # ############################################################################### #
 # Function to write out a KW block line to the PST file for pest++ variables only #
@@ -72,22 +89,81 @@ def write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes,optionalvals=Fa
         writenewline = kwargs['writenewline']        
     except KeyError:
         writenewline = True
+    if writenewline:
+        eol = '\n'
+    else:
+        eol = ''
         
     # check that all mandatorykeys are present
     for ckey in mandatoryvals:
-        if ckey not in cdict.keys():
-            raise(DefaultValueError(mandatoryvals[0],cblock))
-    for cr in xrange(len(cdict[mandatoryvals[0]])):
-        for i,cmand in enumerate(mandatoryvals):
-            write_val(ofp,cdict[cmand][cr],mandatorytypes[i],cmand,cblock)
-        if optionalvals != False:     
-            for i,copt in enumerate(optionalvals):
+        if ckey not in cdict:
+            raise(DefaultValueError(ckey,cblock))
+    # optional columns that are absent are skipped entirely
+    cnames = list(mandatoryvals)
+    ctypes = list(mandatorytypes[:len(mandatoryvals)])
+    if optionalvals != False:     
+        for i,copt in enumerate(optionalvals):
+            if copt in cdict:
+                cnames.append(copt)
+                ctypes.append(optionaltypes[i])
+    # format whole columns at once and write the rows in large buffered chunks
+    nrow = len(cdict[mandatoryvals[0]])
+    for r0 in xrange(0,nrow,WRITE_CHUNK):
+        r1 = min(r0+WRITE_CHUNK,nrow)
+        ccols = [write_col(cdict[cname][r0:r1],ctypes[i],cname,cblock) for i,cname in enumerate(cnames)]
+        ofp.write(eol.join(imap(''.join,izip(*ccols))) + eol)
+
+# ########################################################################### #
+# Function to format a whole table column for the PST file with type-checking #
+# ########################################################################### #
+def write_col(cvals,cvaltype,parnme,blockname):
+    '''returns a list of formatted cells, byte-identical to calling
+    write_val on each cell of the column
+    '''
+    # columns typed at read time need no checking against the UNINIT strings
+    ckind = getattr(getattr(cvals,'dtype',None),'kind','O')
+    if cvaltype == 'int':
+        if ckind in 'iu':
+            cv = cvals.tolist()
+        else:
+            if ckind in 'OSU' and UNINIT_INT in cvals:
+                raise(DefaultValueError(parnme,blockname))
+            cv = list()
+            for cval in cvals:
                 try:
-                    write_val(ofp,cdict[copt][cr],optionaltypes[i],copt,cblock)
-                except KeyError:
-                    pass
-        if writenewline:
-            ofp.write('\n')
+                    cv.append(int(cval))
+                except:
+                    raise(TypeFailError(cval,parnme,cvaltype))
+        return map('%8d'.__mod__,cv)
+    elif cvaltype == 'real':
+        if ckind == 'f':
+            cv = cvals.tolist()
+        else:
+            if ckind in 'OSU' and UNINIT_REAL in cvals:
+                raise(DefaultValueError(parnme,blockname))
+            cv = list()
+            for cval in cvals:
+                try:
+                    cv.append(float(cval))
+                except:
+                    raise(TypeFailError(cval,parnme,cvaltype))
+        return map('%16.8e'.__mod__,cv)
+    elif cvaltype == 'string':
+        if ckind in 'OSU' and UNINIT_STRING in cvals:
+            raise(DefaultValueError(parnme,blockname))
+        cv = list()
+        for cval in cvals:
+            # as in write_val, strings that parse as numbers are not written;
+            # most names start with a letter, so skip the float() attempt for those
+            if isinstance(cval,basestring) and cval[:1] not in NUMSTART:
+                cv.append(' %s ' %(cval))
+            else:
+                try:
+                    float(cval)
+                    cv.append('')
+                except:
+                    cv.append(' %s ' %(cval))
+        return cv
 
 # ############################################################################### #
 # Function to write out a single value to the PST file with type-checking: pest++ # 
@@ -188,7 +264,7 @@ class kw:
 # ########################## #
 class tb:
 
-    def __init__(self,blockname,colnames,nrow=0,ncol=0,blockstart=0,blockend=0):
+    def __init__(self,blockname,colnames,nrow=0,ncol=0,blockstart=0,blockend=0,blocktype='tab'):
         self.blockname = blockname   # name of the block
         self.nrow = nrow             # number of rows to read
         self.ncol = ncol             # number of columns to read
@@ -196,21 +272,1312 @@ class tb:
         self.extfile = UNINIT_STRING # external file in case of external
         self.blockstart = blockstart # starting line for block
         self.blockend = blockend     # ending line for block
+        self.blocktype = blocktype   # 'tab' for inline tables, 'file' for external files
+        self.datastart = None        # line number of the first data row
+        self.clabels = list()        # column labels as given in the block
+        self.streamed = False        # True if the rows are streamed from extfile on output
+        self.cachekey = None         # key of the parsed rows in the block cache
+
+    def row_location(self,crow):
+        '''where row crow (from 0) of the block was given, for error messages'''
+        if self.datastart is None:
+            return 'entry ' + str(crow+1)
+        elif self.blocktype == 'file':
+            return 'line ' + str(self.datastart+crow) + ' of ' + self.extfile
+        return 'line ' + str(self.datastart+crow)
+
+# ############################################### #
+# Class to hold one entry of the .kyp block index #
+# ############################################### #
+class blockinfo:
+
+    def __init__(self,blockname,blocktype,blockstart,blockend=-1):
+        self.blockname = blockname   # name of the block
+        self.blocktype = blocktype   # 'kw', 'tab', or 'file'
+        self.blockstart = blockstart # line of the BEGIN statement
+        self.blockend = blockend     # line of the END statement
 
 
 # ########################### #
 # Function to find duplicates # 
 # ########################### #
-def dedupe(allv,uniqueval):
-    dupes = []
-    for u in uniqueval:
-        k = 0
-        for v in allv:
-            if v == u:
-                k+=1
-        if k>1:
-            dupes.append(u)
-    return dupes
+def find_dupes(allv,ignorecase=False):
+    '''returns a list of (value,indices) for every value occurring more than
+    once, in order of first occurrence; hashing keeps this linear in len(allv)
+    '''
+    if ignorecase:
+        keys = [v.lower() for v in allv]
+    else:
+        keys = list(allv)
+    # most name lists have no duplicates at all
+    if len(set(keys)) == len(keys):
+        return []
+    first = dict()
+    where = dict()
+    for j,k in enumerate(keys):
+        if k in first:
+            if k not in where:
+                where[k] = [first[k]]
+            where[k].append(j)
+        else:
+            first[k] = j
+    return [(allv[idx[0]],idx) for idx in sorted(where.values())]
+
+# ########################################################### #
+# Function to convert a list of table cells to a typed column #
+# ########################################################### #
+def cast_column(cvals,cvaltype,blockname,colname,cline=None,cfile=None):
+    '''convert once, at read time: real -> float64, int -> int64, else object
+    cline is the line number of the first cell, or None to report entry numbers
+    cfile is the external file holding the cells, if any, for error messages
+    '''
+    import numpy as np
+    if cvaltype == 'real':
+        ctype = np.float64
+    elif cvaltype == 'int':
+        ctype = np.int64
+    else:
+        return np.array(cvals,dtype=object)
+    try:
+        return np.array(cvals,dtype=ctype)
+    except (ValueError,TypeError):
+        # find the first offending cell so it can be reported
+        for j,cval in enumerate(cvals):
+            try:
+                ctype(cval)
+            except (ValueError,TypeError):
+                raise(TableTypeError(cval,colname,cvaltype,blockname,j,cline,cfile))
+        raise
+
+# ################################################################# #
+# Class to collect a table column one value at a time, already cast #
+# ################################################################# #
+class column_buffer:
+
+    def __init__(self,cvaltype,blockname,colname):
+        self.cvaltype = cvaltype     # 'real', 'int' or 'string'
+        self.blockname = blockname   # name of the block, for error reporting
+        self.colname = colname       # name of the column, for error reporting
+        if cvaltype == 'real':
+            self.vals = array.array('d')
+            self.conv = float
+        else:
+            self.vals = list()
+            self.conv = None
+
+    def append(self,cval):
+        if self.conv is None:
+            self.vals.append(cval)
+            return
+        try:
+            self.vals.append(self.conv(cval))
+        except ValueError:
+            raise(TableTypeError(cval,self.colname,self.cvaltype,self.blockname,len(self.vals)))
+
+    def array(self):
+        import numpy as np
+        if self.cvaltype == 'real':
+            return np.frombuffer(self.vals,dtype=np.float64) if len(self.vals) else np.zeros(0)
+        return cast_column(self.vals,self.cvaltype,self.blockname,self.colname)
+
+# ############################################################## #
+# Function to split the rows of a table into columns all at once #
+# ############################################################## #
+def split_table_text(cbdata,ncol,checkcomments=True):
+    '''split the lines in cbdata into ncol lists of cells with a single split of
+    the joined text; the cells of each line are counted over the bytes of the text
+    returns None if there is a comment or a line without ncol cells
+    '''
+    import numpy as np
+    # lines read from a file keep their line ends, lines split from a text do not
+    if cbdata[0].endswith('\n'):
+        text = ''.join(cbdata)
+    else:
+        text = '\n'.join(cbdata)
+    if checkcomments and '#' in text:
+        return None
+    cells = text.split()
+    if len(cells) != ncol*len(cbdata):
+        return None
+    # a cell starts wherever whitespace is followed by anything else
+    b = np.frombuffer(text,dtype=np.uint8)
+    isspace = (b == 32) | ((b >= 9) & (b <= 13))
+    starts = np.flatnonzero(isspace[:-1] & ~isspace[1:]) + 1
+    if len(b) > 0 and not isspace[0]:
+        starts = np.concatenate(([0],starts))
+    # the line of a cell is the number of line ends before it
+    ends = np.flatnonzero(b == 10)
+    if len(ends) < len(cbdata) - 1 or len(ends) > len(cbdata):
+        return None
+    counts = np.bincount(np.searchsorted(ends,starts),minlength=len(cbdata))
+    if len(counts) != len(cbdata) or (counts != ncol).any():
+        return None
+    del text,b,isspace,starts,ends
+    return [cells[j::ncol] for j in xrange(ncol)]
+
+# ############################################################# #
+# Function to parse the data rows of a table block into columns #
+# ############################################################# #
+def read_table_rows(cbdata,blockname,clabels,cline,checkcomments=True,cfile=None):
+    '''check every row for comments and the column count, then return a
+    dictionary of typed columns keyed by column label
+    cline is the line number of the first row, used for error reporting
+    checkcomments=False skips the comment test for data already known to be clean
+    cfile is the external file holding the rows, if any, for error messages
+    '''
+    ncol = len(clabels)
+    cols = None
+    if blockname != 'prior_information' and len(cbdata) > 0:
+        cols = split_table_text(cbdata,ncol,checkcomments)
+    if cols is None:
+        # the rows are checked one by one to find the first error
+        rows = list()
+        for j,line in enumerate(cbdata):
+            if checkcomments and '#' in line:
+                raise(TableCommentError(cline+j,blockname,cfile))
+            if blockname != 'prior_information':
+                tmp = line.split()
+                if len(tmp) != ncol:
+                    raise(TableBlockColError(blockname,cline+j,ncol,len(tmp),cfile))
+            else:
+                # prior information equations are kept whole
+                tmp = [line.strip()]
+                if len(tmp[0]) < 1:
+                    raise(TableBlockColError(blockname,cline+j,ncol,0,cfile))
+            rows.append(tmp)
+        if len(rows) > 0:
+            cols = zip(*rows)
+        else:
+            cols = [()] * ncol
+        del rows
+    ctypes = tabcoltypes.get(blockname,dict())
+    cdict = dict()
+    for jj,keyy in enumerate(clabels):
+        cdict[keyy] = cast_column(cols[jj],ctypes.get(keyy,'string'),blockname,keyy,cline,cfile)
+        cols[jj] = None
+    return cdict
+
+# ############################################################### #
+# Function to stream the rows of an external table file in chunks #
+# ############################################################### #
+def iter_table_file(cblock,chunksize):
+    '''yield dictionaries of typed columns for about chunksize rows at a time,
+    checking the row count against the NROW header once the file is exhausted
+    '''
+    try:
+        mf = open_table_file(cblock.extfile)
+    except EnvironmentError:
+        raise(ExternalFileOpenError(cblock.extfile,cblock.blockname))
+    nrow = 0
+    try:
+        # skip the header and column label lines
+        mf.readlines(2)
+        # one scan of the mapped data replaces the per-row comment test when clean
+        hascomment = mf.find('#') >= 0
+        for cbdata in mf.chunks(chunksize):
+            yield read_table_rows(cbdata,cblock.blockname,cblock.clabels,cblock.datastart+nrow,
+                                  checkcomments=hascomment,cfile=cblock.extfile)
+            nrow += len(cbdata)
+    finally:
+        mf.close()
+    if nrow != cblock.nrow:
+        raise(TableBlockRowError(cblock.blockname,cblock.nrow,nrow))
+
+# ######################################################### #
+# Functions to read an external table saved as numpy arrays #
+# ######################################################### #
+def read_array_table(cblock):
+    '''typed columns of an external table saved as a .npz archive holding an array
+    for each column label, or as a .npy structured array whose fields are the
+    labels; .npy files are memory mapped, so numeric fields already of the column
+    type are never copied. Sets the labels and size of cblock from the arrays.
+    '''
+    import numpy as np
+    fname = cblock.extfile
+    if compression_ext(fname):
+        raise(ArrayTableError(fname,cblock.blockname,'compressed arrays cannot be read; '+
+                              'numpy.savez_compressed gives a compressed .npz'))
+    try:
+        if control_format(fname) == 'npz':
+            arrays = np.load(fname,allow_pickle=False)
+            labels = arrays.files
+        else:
+            arrays = np.load(fname,mmap_mode='r',allow_pickle=False)
+            labels = arrays.dtype.names
+            if labels is None:
+                raise(ArrayTableError(fname,cblock.blockname,'the array has no named fields'))
+    except EnvironmentError:
+        raise(ExternalFileOpenError(fname,cblock.blockname))
+    except ValueError as e:
+        raise(ArrayTableError(fname,cblock.blockname,str(e)))
+    ctypes = tabcoltypes.get(cblock.blockname,dict())
+    cdict = dict()
+    clabels = list()
+    nrow = None
+    try:
+        for label in labels:
+            # labels are matched in upper case, as for XLS headers
+            colname = label.upper()
+            if colname not in cblock.colnames:
+                raise(BlockIllegalColumn(cblock.blockname,label))
+            cvals = arrays[label]
+            if cvals.ndim != 1:
+                raise(ArrayTableError(fname,cblock.blockname,'column %s is not one dimensional' % label))
+            if nrow is None:
+                nrow = len(cvals)
+            elif len(cvals) != nrow:
+                raise(ArrayTableError(fname,cblock.blockname,'column %s has %d rows, not %d' % (label,len(cvals),nrow)))
+            cdict[colname] = cast_array(cvals,ctypes.get(colname,'string'),cblock.blockname,colname,fname)
+            clabels.append(colname)
+    finally:
+        # a .npz holds its file open, a memory mapped .npy has no close
+        if hasattr(arrays,'close'):
+            arrays.close()
+    cblock.clabels = clabels
+    cblock.ncol = len(clabels)
+    cblock.nrow = nrow or 0
+    cblock.datastart = None
+    return cdict
+
+# ############################################### #
+# Function to read an external table saved as CSV #
+# ############################################### #
+def read_csv_table(cblock,chunksize):
+    '''typed columns of an external table saved as CSV, whose first line that
+    is not blank holds the column labels in place of the NROW/NCOL/COLUMNLABELS
+    lines. The rows are read and cast chunksize at a time. Chunks without quotes
+    or blank lines are split all at once, the others row by row with the csv
+    module. Sets the labels and size of cblock from the file.
+    '''
+    import csv
+    fname = cblock.extfile
+    try:
+        mf = open_table_file(fname)
+    except EnvironmentError:
+        raise(ExternalFileOpenError(fname,cblock.blockname))
+    chunks = list()
+    nrow = 0
+    try:
+        cline = 0
+        header = None
+        while header is None:
+            lines = mf.readlines(1)
+            if len(lines) == 0:
+                raise(TableBlockEmpty(cblock.blockname,1))
+            cline += 1
+            # editors on Windows often start a UTF-8 file with a byte order mark
+            if cline == 1 and lines[0].startswith('\xef\xbb\xbf'):
+                lines[0] = lines[0][3:]
+            if len(lines[0].strip()) > 0:
+                header = csv.reader(lines,skipinitialspace=True).next()
+        # labels are matched in upper case, as for XLS headers
+        clabels = [label.strip().upper() for label in header]
+        for label in clabels:
+            if label not in cblock.colnames:
+                raise(BlockIllegalColumn(cblock.blockname,label))
+        cblock.clabels = clabels
+        cblock.ncol = ncol = len(clabels)
+        cline += 1
+        cblock.datastart = cline
+        # one scan of the mapped data replaces the per-row comment test when clean
+        hascomment = mf.find('#') >= 0
+        for lines in mf.chunks(chunksize):
+            if hascomment:
+                for j,line in enumerate(lines):
+                    if '#' in line:
+                        raise(TableCommentError(cline+j,cblock.blockname,fname))
+            cols = split_csv_text(lines,ncol)
+            if cols is not None:
+                chunks.append(cast_csv_cols(cols,cblock,cline))
+                nrow += len(lines)
+                cline += len(lines)
+                continue
+            # each run of rows between blank lines is cast on its own so
+            # that errors are reported on the right line
+            rows = list()
+            reader = csv.reader(lines,skipinitialspace=True)
+            for row in reader:
+                # only blank lines are skipped, a row of empty cells is an error
+                if len(row) == 0 or (len(row) == 1 and len(row[0].strip()) == 0):
+                    if len(rows) > 0:
+                        chunks.append(cast_csv_cols(zip(*rows),cblock,start))
+                        nrow += len(rows)
+                        rows = list()
+                    continue
+                if len(row) != ncol:
+                    raise(TableBlockColError(cblock.blockname,cline+reader.line_num-1,ncol,len(row),fname))
+                if len(rows) == 0:
+                    start = cline + reader.line_num - 1
+                rows.append(row)
+            if len(rows) > 0:
+                chunks.append(cast_csv_cols(zip(*rows),cblock,start))
+                nrow += len(rows)
+            cline += len(lines)
+        if len(chunks) == 0:
+            chunks.append(cast_csv_cols([()] * ncol,cblock,cline))
+    finally:
+        mf.close()
+    cblock.nrow = nrow
+    return concat_columns(chunks)
+
+def split_csv_text(lines,ncol):
+    '''split CSV lines into ncol lists of cells with a single split of the joined
+    text, as split_table_text does; the commas of each line are counted over the
+    bytes of the text. Returns None if a cell is quoted or a line is blank or
+    does not have ncol cells.
+    '''
+    import numpy as np
+    text = '\n'.join(lines)
+    if '"' in text:
+        return None
+    b = np.frombuffer(text,dtype=np.uint8)
+    ends = np.flatnonzero(b == 10)
+    if ncol == 1:
+        # no commas to count, so look for blank lines instead
+        if min([len(line.strip()) for line in lines]) == 0:
+            return None
+        return [text.split('\n')]
+    # the line of a comma is the number of line ends before it
+    commas = np.flatnonzero(b == 44)
+    if len(commas) != (ncol-1) * len(lines):
+        return None
+    counts = np.bincount(np.searchsorted(ends,commas),minlength=len(lines))
+    if len(counts) != len(lines) or (counts != ncol-1).any():
+        return None
+    del b,ends,commas
+    cells = text.replace('\n',',').split(',')
+    return [cells[j::ncol] for j in xrange(ncol)]
+
+def cast_csv_cols(cols,cblock,cline):
+    '''typed columns of the cells of CSV rows, the first on line cline'''
+    ctypes = tabcoltypes.get(cblock.blockname,dict())
+    cdict = dict()
+    for j,colname in enumerate(cblock.clabels):
+        cvaltype = ctypes.get(colname,'string')
+        cvals = cols[j]
+        if cvaltype == 'string':
+            # names never hold spaces, but CSV writers may pad the cells
+            # and leave the carriage return of each line in the last one
+            cvals = [cval.strip() for cval in cvals]
+            # prior information equations are kept whole
+            if cblock.blockname != 'prior_information':
+                check_name_cells(cvals,cblock.blockname,colname,cline,cblock.extfile)
+        cdict[colname] = cast_column(cvals,cvaltype,cblock.blockname,colname,cline,cblock.extfile)
+    return cdict
+
+def check_name_cells(cvals,blockname,colname,cline=None,cfile=None):
+    '''raise TableTypeError for the first name that is empty or holds
+    whitespace, either of which would shift the columns after it in the PST file
+    '''
+    if '' in cvals:
+        raise(TableTypeError('',colname,'string',blockname,cvals.index(''),cline,cfile))
+    if re.search(r'\s',''.join(cvals)) is not None:
+        for k,cval in enumerate(cvals):
+            if re.search(r'\s',cval) is not None:
+                raise(TableTypeError(cval,colname,'string',blockname,k,cline,cfile))
+
+def cast_array(cvals,cvaltype,blockname,colname,cfile=None):
+    '''cast_column for a column given as an array: numeric arrays of the column
+    type are used as they are, other numeric arrays are converted and text goes
+    through cast_column; string columns must be given as text
+    cfile is the file holding the array, for error messages
+    '''
+    import numpy as np
+    if cvaltype in ('real','int') and cvals.dtype.kind in 'biuf':
+        ctype = np.float64 if cvaltype == 'real' else np.int64
+        if cvals.dtype == ctype:
+            return cvals
+        if ctype == np.int64 and cvals.dtype.kind == 'f':
+            # fractions, NaN and values out of the int64 range
+            with np.errstate(invalid='ignore'):
+                bad = np.nonzero((cvals != np.round(cvals)) | (cvals < -2.0**63) | (cvals >= 2.0**63))[0]
+            if len(bad) > 0:
+                raise(TableTypeError(cvals[bad[0]],colname,cvaltype,blockname,bad[0],None,cfile))
+        elif ctype == np.int64 and cvals.dtype == np.uint64:
+            # the unsigned values above the int64 maximum would wrap
+            bad = np.nonzero(cvals > np.uint64(np.iinfo(np.int64).max))[0]
+            if len(bad) > 0:
+                raise(TableTypeError(cvals[bad[0]],colname,cvaltype,blockname,bad[0],None,cfile))
+        return cvals.astype(ctype)
+    if cvals.dtype.kind == 'S':
+        cvals = cvals.tolist()
+    elif cvals.dtype.kind == 'U':
+        cvals = cvals.astype(str).tolist()
+    elif cvaltype == 'string':
+        # numbers as names look like values to the writers, which drop them
+        if len(cvals) > 0:
+            raise(TableTypeError(cvals[0],colname,cvaltype,blockname,0,None,cfile))
+        cvals = []
+    else:
+        # any other kind of array, floats with all their digits
+        cvals = [repr(v) if isinstance(v,float) else str(v) for v in cvals.tolist()]
+    if cvaltype == 'string':
+        check_name_cells(cvals,blockname,colname,None,cfile)
+    return cast_column(cvals,cvaltype,blockname,colname,None,cfile)
+
+# ###################################################################### #
+# Functions to open files compressed with gzip, bzip2 or xz by extension #
+# ###################################################################### #
+def compression_ext(fname):
+    '''the compression extension of fname ('.gz', '.bz2' or '.xz'), or an empty string'''
+    for ext in ('.gz','.bz2','.xz'):
+        if fname.lower().endswith(ext):
+            return ext
+    return ''
+
+def control_format(fname):
+    '''the extension of fname without any compression extension, in lower case'''
+    base = fname[:len(fname)-len(compression_ext(fname))]
+    return os.path.splitext(base)[1][1:].lower()
+
+def case_name(fname):
+    '''fname without its extension and any compression extension'''
+    base = fname[:len(fname)-len(compression_ext(fname))]
+    return os.path.splitext(base)[0]
+
+def open_compressed(fname,mode='rb'):
+    '''open fname, compressed or not as its extension says; compressed files
+    are decompressed or compressed a block at a time as they are read or written
+    '''
+    ext = compression_ext(fname)
+    if ext == '.gz':
+        import gzip
+        # level 6, as the gzip program uses, writes much faster than the
+        # default of 9 for files only slightly larger
+        return gzip.open(fname,mode,6)
+    elif ext == '.bz2':
+        import bz2
+        return bz2.BZ2File(fname,mode)
+    elif ext == '.xz':
+        # in the standard library from python 3.3, as backports.lzma before
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise(CompressionModuleError(fname,'lzma'))
+        return lzma.LZMAFile(fname,mode)
+    return open(fname,mode)
+
+def open_table_file(fname):
+    '''open an external table file over a memory map, or, compressed files
+    not being mappable, decompressed as it is read
+    '''
+    if compression_ext(fname):
+        return compressed_file(fname)
+    return mapped_file(fname)
+
+# ###################################################### #
+# Class to read an external table file over a memory map #
+# ###################################################### #
+class mapped_file:
+
+    def __init__(self,fname):
+        self.fname = fname
+        self.fp = open(fname,'rb')
+        try:
+            self.mm = mmap.mmap(self.fp.fileno(),0,access=mmap.ACCESS_READ)
+        except (ValueError,EnvironmentError):
+            # empty files cannot be mapped
+            self.mm = ''
+        self.pos = 0                 # offset of the next unread line
+
+    def find(self,sub):
+        '''offset of sub in the unread part of the file, or -1'''
+        return self.mm.find(sub,self.pos)
+
+    def readlines(self,n):
+        '''return the next n lines (without line ends)'''
+        lines = list()
+        size = len(self.mm)
+        while len(lines) < n and self.pos < size:
+            end = self.mm.find('\n',self.pos)
+            if end < 0:
+                end = size
+            lines.append(self.mm[self.pos:end])
+            self.pos = end + 1
+        return lines
+
+    def spans(self,nlines):
+        '''yield (start,end) offsets of blocks of about nlines lines, cut on line
+        boundaries; the line length is estimated from the first 64 kB
+        '''
+        size = len(self.mm)
+        sample = self.mm[self.pos:self.pos+65536]
+        nbytes = max(nlines * (len(sample) // max(sample.count('\n'),1) + 1),1)
+        while self.pos < size:
+            start = self.pos
+            end = min(start+nbytes,size)
+            if end < size:
+                end = self.mm.find('\n',end)
+                if end < 0:
+                    end = size
+                else:
+                    end += 1
+            self.pos = end
+            yield start,end
+
+    def chunks(self,nlines):
+        '''yield lists of about nlines lines, each block of text being copied
+        from the map and split only once
+        '''
+        for start,end in self.spans(nlines):
+            yield split_lines(self.mm[start:end])
+
+    def sha1(self):
+        '''hex digest of the whole file contents'''
+        h = hashlib.sha1()
+        for start in xrange(0,len(self.mm),2**24):
+            h.update(self.mm[start:start+2**24])
+        return h.hexdigest()
+
+    def close(self):
+        if not isinstance(self.mm,str):
+            self.mm.close()
+        self.fp.close()
+
+# ########################################################################### #
+# Class to read a compressed external table file, decompressing it as it goes #
+# ########################################################################### #
+class compressed_file:
+
+    def __init__(self,fname):
+        self.fname = fname
+        self.fp = open_compressed(fname,'rb')
+        self.buf = ''                # text decompressed but not yet returned
+        self.eof = False
+
+    def fill(self,nbytes):
+        '''decompress until nbytes are buffered or the file ends'''
+        parts = [self.buf]
+        size = len(self.buf)
+        while size < nbytes and not self.eof:
+            data = self.fp.read(max(nbytes-size,65536))
+            if len(data) == 0:
+                self.eof = True
+            parts.append(data)
+            size += len(data)
+        self.buf = ''.join(parts)
+
+    def find(self,sub):
+        '''the rest of the file is not known without decompressing it, so sub
+        is taken to be there
+        '''
+        return 0
+
+    def readlines(self,n):
+        '''return the next n lines (without line ends)'''
+        lines = list()
+        while len(lines) < n:
+            end = self.buf.find('\n')
+            while end < 0 and not self.eof:
+                self.fill(len(self.buf)+65536)
+                end = self.buf.find('\n')
+            if end < 0:
+                if len(self.buf) > 0:
+                    lines.append(self.buf)
+                    self.buf = ''
+                break
+            lines.append(self.buf[:end])
+            self.buf = self.buf[end+1:]
+        return lines
+
+    def chunks(self,nlines):
+        '''yield lists of about nlines lines, the line length being estimated
+        from the first 64 kB as in mapped_file.spans
+        '''
+        self.fill(65536)
+        sample = self.buf[:65536]
+        nbytes = max(nlines * (len(sample) // max(sample.count('\n'),1) + 1),1)
+        while True:
+            self.fill(nbytes)
+            if len(self.buf) == 0:
+                return
+            end = self.buf.rfind('\n')
+            while end < 0 and not self.eof:
+                self.fill(len(self.buf)+nbytes)
+                end = self.buf.rfind('\n')
+            if end < 0 or self.eof:
+                text = self.buf
+                self.buf = ''
+            else:
+                text = self.buf[:end+1]
+                self.buf = self.buf[end+1:]
+            yield split_lines(text)
+
+    def sha1(self):
+        '''hex digest of the compressed file, which changes whenever its contents do'''
+        h = hashlib.sha1()
+        fp = open(self.fname,'rb')
+        try:
+            for data in iter(lambda: fp.read(2**24),''):
+                h.update(data)
+        finally:
+            fp.close()
+        return h.hexdigest()
+
+    def close(self):
+        self.fp.close()
+
+# ####################################################### #
+# Function to rename a file over another, on any platform #
+# ####################################################### #
+def replace_file(src,dest):
+    '''rename src to dest, replacing dest; os.rename does so atomically on
+    POSIX, but raises on Windows when dest exists, so it is removed first there
+    '''
+    if os.name == 'nt' and os.path.exists(dest):
+        os.remove(dest)
+    os.rename(src,dest)
+
+# ###################################################################### #
+# Class to cache parsed blocks on disk, keyed by a hash of their content #
+# ###################################################################### #
+class block_cache:
+
+    def __init__(self,cachedir,maxsize=CACHE_SIZE):
+        self.cachedir = cachedir     # directory holding one file per cached block
+        self.maxsize = maxsize       # least recently used entries are evicted above this size
+        self.hits = 0
+        self.misses = 0
+        self.size = None             # bytes of the entries, counted by the first evict
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def key(self,*parts):
+        '''hex digest over CACHE_VERSION and the string parts'''
+        h = hashlib.sha1(CACHE_VERSION)
+        for p in parts:
+            h.update('%d:' % len(p))
+            h.update(p)
+        return h.hexdigest()
+
+    def get(self,key):
+        '''return the cached object or None'''
+        fname = os.path.join(self.cachedir,key+'.kpc')
+        try:
+            fp = open(fname,'rb')
+        except EnvironmentError:
+            self.misses += 1
+            return None
+        try:
+            obj = cPickle.load(fp)
+        except Exception:
+            # a truncated or stale entry is treated as a miss
+            fp.close()
+            self.misses += 1
+            return None
+        fp.close()
+        # mark the entry as recently used
+        try:
+            os.utime(fname,None)
+        except EnvironmentError:
+            pass
+        self.hits += 1
+        return obj
+
+    def put(self,key,obj):
+        fname = os.path.join(self.cachedir,key+'.kpc')
+        tmpname = '%s.%d.tmp' % (fname,os.getpid())
+        try:
+            oldsize = os.stat(fname).st_size
+        except EnvironmentError:
+            oldsize = 0
+        # write then rename so that readers never see a partial entry; the
+        # cache only saves time, so a failed write must not stop the conversion
+        try:
+            fp = open(tmpname,'wb')
+            try:
+                cPickle.dump(obj,fp,cPickle.HIGHEST_PROTOCOL)
+                newsize = fp.tell()
+            finally:
+                fp.close()
+            replace_file(tmpname,fname)
+        except EnvironmentError as e:
+            print 'Warning: block not cached: %s' % e
+            if os.path.exists(tmpname):
+                try:
+                    os.remove(tmpname)
+                except EnvironmentError:
+                    pass
+            return
+        # the directory is only listed when the running total is over the limit
+        if self.size is None:
+            self.evict()
+        else:
+            self.size += newsize - oldsize
+            if self.size > self.maxsize:
+                self.evict()
+
+    def evict(self):
+        '''remove the least recently used entries until the cache fits in maxsize'''
+        entries = list()
+        total = 0
+        for cf in os.listdir(self.cachedir):
+            if not cf.endswith('.kpc'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cachedir,cf))
+            except EnvironmentError:
+                continue
+            entries.append((st.st_mtime,st.st_size,cf))
+            total += st.st_size
+        entries.sort()
+        for mtime,size,cf in entries:
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(os.path.join(self.cachedir,cf))
+            except EnvironmentError:
+                continue
+            total -= size
+        self.size = total
+
+# ################################################################ #
+# Class to cache parsed blocks in memory for the life of a process #
+# ################################################################ #
+class memory_cache(block_cache):
+
+    def __init__(self,maxsize=CACHE_SIZE):
+        from collections import OrderedDict
+        self.maxsize = maxsize       # least recently used entries are evicted above this size
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict() # pickled objects, least recently used first
+        self.used = set()            # keys used since the last sweep
+        self.size = 0
+
+    def get(self,key):
+        '''return a copy of the cached object or None'''
+        pobj = self.entries.pop(key,None)
+        if pobj is None:
+            self.misses += 1
+            return None
+        # move the entry to the recently used end
+        self.entries[key] = pobj
+        self.used.add(key)
+        self.hits += 1
+        # the objects are stored pickled so that changes to a returned
+        # object never reach the cache
+        return cPickle.loads(pobj)
+
+    def put(self,key,obj):
+        pobj = cPickle.dumps(obj,cPickle.HIGHEST_PROTOCOL)
+        old = self.entries.pop(key,None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = pobj
+        self.used.add(key)
+        self.size += len(pobj)
+        self.evict()
+
+    def evict(self):
+        '''remove the least recently used entries until the cache fits in maxsize'''
+        while self.size > self.maxsize and len(self.entries) > 0:
+            key,pobj = self.entries.popitem(last=False)
+            self.size -= len(pobj)
+
+    def sweep(self):
+        '''remove the entries not used since the last sweep'''
+        for key in self.entries.keys():
+            if key not in self.used:
+                self.size -= len(self.entries.pop(key))
+        self.used = set()
+
+# ################################################################## #
+# Function to split a block of text into lines without the line ends #
+# ################################################################## #
+def split_lines(text):
+    lines = text.split('\n')
+    # drop the empty piece after the final line end
+    if lines[-1] == '':
+        lines.pop()
+    return lines
+
+# ############################################################### #
+# Function run by the worker processes to parse one chunk of rows #
+# ############################################################### #
+def read_table_task(task):
+    '''task is (blockname,clabels,cline,cbdata) where cbdata is a list of lines
+    or an (extfile,start,end) byte range of an external file
+    returns (True,columns) or (False,error) since the exceptions cannot be pickled
+    '''
+    blockname,clabels,cline,cbdata = task
+    try:
+        checkcomments = True
+        cfile = None
+        if isinstance(cbdata,tuple):
+            cfile = cbdata[0]
+            mf = mapped_file(cbdata[0])
+            try:
+                text = mf.mm[cbdata[1]:cbdata[2]]
+            finally:
+                mf.close()
+            checkcomments = '#' in text
+            cbdata = split_lines(text)
+            del text
+        return True,read_table_rows(cbdata,blockname,clabels,cline,checkcomments,cfile)
+    except Exception as e:
+        return False,(e.__class__,e.args,e.__dict__)
+
+# ############################################################## #
+# Function to re-raise an exception returned by a worker process #
+# ############################################################## #
+def raise_task_error(err):
+    cls,args,attrs = err
+    e = cls.__new__(cls)
+    e.args = args
+    e.__dict__.update(attrs)
+    raise e
+
+# ###################################################### #
+# Function to join chunks of typed columns back together #
+# ###################################################### #
+def concat_columns(chunks):
+    import numpy as np
+    allcols = dict()
+    for cdict in chunks:
+        for k,v in cdict.iteritems():
+            allcols.setdefault(k,[]).append(v)
+    for k in allcols:
+        allcols[k] = np.concatenate(allcols[k])
+    return allcols
+
+# ########################################################## #
+# Functions to escape text the way ElementTree serializes it #
+# ########################################################## #
+def xml_escape_cdata(text):
+    if '&' in text:
+        text = text.replace('&','&amp;')
+    if '<' in text:
+        text = text.replace('<','&lt;')
+    if '>' in text:
+        text = text.replace('>','&gt;')
+    return text
+
+def xml_escape_attrib(text):
+    text = xml_escape_cdata(text)
+    if '"' in text:
+        text = text.replace('"','&quot;')
+    if '\n' in text:
+        text = text.replace('\n','&#10;')
+    return text
+
+# ########################################################### #
+# Functions to turn the names of the table rows into XML tags #
+# ########################################################### #
+XML_TAGCHARS = string.ascii_letters + string.digits + '_.-\n'
+def xml_tag(name):
+    '''name made a valid XML tag: characters other than letters, digits, '_',
+    '.' and '-' become '_', and '_' is put before a tag that does not start with
+    a letter or '_'
+    '''
+    tag = re.sub(r'[^\w.-]','_',name)
+    if not re.match(r'[A-Za-z_]',tag):
+        tag = '_' + tag
+    return tag
+
+def xml_tags(names):
+    '''xml_tag of each name, checking all of them with a single search first'''
+    names = [str(t) for t in names]
+    # each name follows a line end, which must be followed by a letter or '_'
+    text = '\n' + '\n'.join(names)
+    if (not text.translate(None,XML_TAGCHARS) and not text.endswith('\n') and
+            re.search(r'\n[^A-Za-z_]',text) is None):
+        return names
+    return [xml_tag(t) for t in names]
+
+# ############################################################## #
+# Function to format a column as empty XML elements with a value #
+# ############################################################## #
+def xml_write_col(colname,cvals,indent='\n      '):
+    '''returns a list of <colname value="..." /> strings, uninitialized
+    values giving <colname />
+    '''
+    import numpy as np
+    empty = indent + '<' + colname + ' />'
+    fmt = indent + '<' + colname + ' value="%s" />'
+    if isinstance(cvals,np.ndarray) and cvals.dtype.kind in 'if':
+        return [fmt % str(v) for v in cvals]
+    return [empty if v in UNINIT else fmt % xml_escape_attrib(str(v)) for v in cvals]
+
+# ################################################################# #
+# Function to find the rows of a table chunk failing numeric checks #
+# ################################################################# #
+def value_checks(blockname,cdict):
+    '''returns a list of (check,mask) where mask is True for the failing rows;
+    checks whose columns are absent are left out
+    '''
+    import numpy as np
+    checks = list()
+    if blockname == 'parameter_data':
+        if 'PARVAL1' in cdict and 'PARLBND' in cdict:
+            checks.append(('PARVAL1 < PARLBND',cdict['PARVAL1'] < cdict['PARLBND']))
+        if 'PARVAL1' in cdict and 'PARUBND' in cdict:
+            checks.append(('PARVAL1 > PARUBND',cdict['PARVAL1'] > cdict['PARUBND']))
+        if 'PARTRANS' in cdict and 'PARLBND' in cdict:
+            islog = np.char.lower(cdict['PARTRANS'].astype(str)) == 'log'
+            checks.append(('PARLBND <= 0 with PARTRANS log',islog & (cdict['PARLBND'] <= 0)))
+        if 'SCALE' in cdict:
+            checks.append(('SCALE == 0',cdict['SCALE'] == 0))
+    elif blockname == 'observation_data':
+        if 'OBSVAL' in cdict:
+            checks.append(('OBSVAL not finite',~np.isfinite(cdict['OBSVAL'])))
+        if 'WEIGHT' in cdict:
+            checks.append(('WEIGHT < 0',cdict['WEIGHT'] < 0))
+    return checks
+
+# ############################################################# #
+# Function to open an output file, passing file objects through #
+# ############################################################# #
+def open_output(dest):
+    '''returns (file object,True if it was opened here and should be closed)'''
+    if hasattr(dest,'write'):
+        return dest,False
+    if compression_ext(dest):
+        return open_compressed(dest,'wb'),True
+    return open(dest,'w'),True
+
+def write_output(writer,dest):
+    '''call writer with a file object for dest; a named file is written under a
+    temporary name beside it and renamed over dest once complete, so that an
+    error leaves no partial file and, until the rename, the earlier dest as it was
+    '''
+    if hasattr(dest,'write'):
+        return writer(dest)
+    dname,bname = os.path.split(dest)
+    tmpname = os.path.join(dname,'.%d.%s' % (os.getpid(),bname))
+    ofp = open_output(tmpname)[0]
+    try:
+        try:
+            writer(ofp)
+        finally:
+            ofp.close()
+        replace_file(tmpname,dest)
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+# ############################################################### #
+# Functions to convert many control files across worker processes #
+# ############################################################### #
+def convert_file(task):
+    '''convert one <casename>.kyp or <casename>.pst to each output type, catching any error
+    task is (fname,outtypes,kwargs) with kwargs passed to file_control
+    returns (fname,error,seconds) where error is None or the error message
+    '''
+    fname,outtypes,kwargs = task
+    t0 = time.time()
+    try:
+        fmt = control_format(fname)
+        if fmt not in ('kyp','pst'):
+            raise(InvalidInputExtension(fname))
+        casename = case_name(fname)
+        main_control = file_control(**kwargs)
+        main_control.read(fname)
+        # never write over the input file
+        main_control.write_many([casename+'.'+ext for ext in outtypes if control_format('.'+ext) != fmt])
+        if main_control.profiler is not None:
+            print '\n' + fname + '\n' + main_control.profiler.summary()
+    except Exception as e:
+        return fname,e.__class__.__name__+': '+str(e).strip(),time.time()-t0
+    return fname,None,time.time()-t0
+
+def cpu_count():
+    '''number of cpus, 1 if it cannot be told'''
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError,NotImplementedError):
+        return 1
+
+def find_defaults_file():
+    '''name of the key_defaults.txt file in the working directory, in any case, or None'''
+    for cf in os.listdir(os.getcwd()):
+        if cf.lower() == 'key_defaults.txt':
+            return cf
+    return None
+
+def file_stamps(fnames):
+    '''dictionary of the (modification time, size) of each file, None if it is missing'''
+    stamps = dict()
+    for fname in fnames:
+        try:
+            st = os.stat(fname)
+            stamps[fname] = (st.st_mtime,st.st_size)
+        except EnvironmentError:
+            stamps[fname] = None
+    return stamps
+
+def watch_file(fname,outtypes=('pst','xml'),interval=1.0,maxcycles=None,**kwargs):
+    '''convert fname to each output type, then again whenever it, the external
+    files of its FILE table blocks or key_defaults.txt change; the parsed blocks
+    are kept in a memory_cache so that only blocks whose text or external file
+    changed are parsed again. kwargs are passed to file_control.
+    Runs until interrupted, or for maxcycles conversions.
+    '''
+    fmt = control_format(fname)
+    if fmt not in ('kyp','pst'):
+        raise(InvalidInputExtension(fname))
+    casename = case_name(fname)
+    if kwargs.get('cache') is None:
+        kwargs['cache'] = memory_cache(kwargs.pop('cachesize',CACHE_SIZE))
+    kwargs.pop('cachedir',None)
+    kwargs.pop('cachesize',None)
+    memo = kwargs['cache']
+    extfiles = list()
+    stamps = None
+    ncycles = 0
+    while maxcycles is None or ncycles < maxcycles:
+        watched = [fname] + extfiles
+        defaults_file = find_defaults_file()
+        if defaults_file is not None:
+            watched.append(defaults_file)
+        current = file_stamps(watched)
+        if current == stamps:
+            time.sleep(interval)
+            continue
+        stamps = current
+        ncycles += 1
+        t0 = time.time()
+        hits,misses = memo.hits,memo.misses
+        main_control = file_control(**kwargs)
+        try:
+            main_control.read(fname)
+            # never write over the input file
+            main_control.write_many([casename+'.'+ext for ext in outtypes if control_format('.'+ext) != fmt])
+        except Exception as e:
+            print 'keyPEST: %s FAILED, waiting for changes\n%s' % (fname,e.__class__.__name__+': '+str(e).strip())
+            # keep watching the external files of the last good version too
+            failed = set(extfiles)
+        else:
+            print 'keyPEST: %s converted in %.2f s (%d blocks parsed, %d reused)' % (fname,time.time()-t0,
+                                                                                 memo.misses-misses,memo.hits-hits)
+            if main_control.profiler is not None:
+                print '\n' + main_control.profiler.summary()
+            # forget the blocks of earlier versions of the file
+            if isinstance(memo,memory_cache):
+                memo.sweep()
+            failed = set()
+        sys.stdout.flush()
+        # watch the external files named by this version of the file
+        extfiles = sorted(failed | set([cb.extfile for cb in main_control.tabblocks.itervalues()
+                                        if cb.extfile != UNINIT_STRING]))
+        newstamps = file_stamps([cf for cf in extfiles if cf not in stamps])
+        for cf in [fname,defaults_file] + extfiles:
+            if cf in stamps:
+                newstamps[cf] = stamps[cf]
+        stamps = newstamps
+
+def convert_files(fnames,outtypes=('pst','xml'),njobs=1,**kwargs):
+    '''convert each file in fnames with convert_file, njobs files at a time
+    returns the convert_file results in the order of fnames
+    '''
+    if njobs > 1 and len(fnames) > 1:
+        # the pool workers cannot start worker pools of their own
+        kwargs['nworkers'] = 1
+    tasks = [(fname,outtypes,kwargs) for fname in fnames]
+    if njobs <= 1 or len(tasks) < 2:
+        return [convert_file(t) for t in tasks]
+    import multiprocessing
+    pool = multiprocessing.Pool(min(njobs,len(tasks)))
+    try:
+        results = list(pool.imap(convert_file,tasks))
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    return results
+
+# ######################################################### #
+# Functions to interpret the positional values of PST files #
+# ######################################################### #
+def pst_token_fits(cval,cvaltype):
+    '''True if the PST value cval can be a value of type cvaltype'''
+    try:
+        if cvaltype == 'int':
+            int(cval)
+        elif cvaltype == 'real':
+            # fortran double precision exponents are allowed
+            float(cval.lower().replace('d','e'))
+    except ValueError:
+        return False
+    return True
+
+def pst_int(cdict,cpar):
+    try:
+        return int(cdict[cpar])
+    except (ValueError,TypeError):
+        raise(TypeFailError(cdict[cpar],cpar,'int'))
+
+def pst_chunk_nrow(chunk):
+    '''rows in a dictionary of typed columns'''
+    if len(chunk) == 0:
+        return 0
+    return len(chunk.values()[0])
+
+# ############################################################# #
+# Functions to measure the peak resident memory of this process #
+# ############################################################# #
+def reset_peak_rss():
+    '''start a new peak memory measurement where the kernel allows it (linux)'''
+    try:
+        fp = open('/proc/self/clear_refs','w')
+        try:
+            fp.write('5')
+        finally:
+            fp.close()
+    except EnvironmentError:
+        pass
+
+def peak_rss_mb():
+    '''peak resident memory in MB since reset_peak_rss, or since the process
+    started where the peak cannot be reset
+    '''
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    except EnvironmentError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac os x
+    if sys.platform == 'darwin':
+        return maxrss / 1048576.0
+    return maxrss / 1024.0
+
+# ###################################################### #
+# Class to record the time and memory of each work stage #
+# ###################################################### #
+class stage_profiler:
+
+    def __init__(self,callback=None):
+        self.callback = callback     # called with each record as soon as it is made
+        self.records = list()        # one record per stage, in the order they ran
+
+    def run(self,stage,fc,func,*args):
+        '''run func(*args) as stage of file_control fc; the record holds the
+        stage name, seconds, peak memory in MB and the rows of each table block
+        '''
+        reset_peak_rss()
+        t0 = time.time()
+        try:
+            return func(*args)
+        finally:
+            record = {'stage' : stage,
+                      'seconds' : time.time() - t0,
+                      'peak_mb' : peak_rss_mb(),
+                      'rows' : fc.tab_rows()}
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def summary(self):
+        '''a table of the stages and of the rows of each table block'''
+        lines = ['%-26s %10s %10s' % ('stage','seconds','peak MB')]
+        for r in self.records:
+            lines.append('%-26s %10.3f %10.1f' % (r['stage'],r['seconds'],r['peak_mb']))
+        if len(self.records) > 0:
+            lines.append('%-26s %10.3f %10.1f' % ('total',sum([r['seconds'] for r in self.records]),
+                                                 max([r['peak_mb'] for r in self.records])))
+            rows = self.records[-1]['rows']
+            if len(rows) > 0:
+                lines.append('')
+                lines.append('%-26s %10s' % ('table block','rows'))
+                for name in sorted(rows):
+                    lines.append('%-26s %10d' % (name,rows[name]))
+        return '\n'.join(lines)
+
+# ############################################################# #
+# Columns of a table block, parsed on first use of their values #
+# ############################################################# #
+class lazy_columns(dict):
+
+    def __init__(self,fc,cblock):
+        dict.__init__(self)
+        self.fc = fc                 # the file_control that owns the block
+        self.cblock = cblock         # tb holding the header and the place of the rows
+        self.loaded = False
+
+    def load(self):
+        '''parse the rows into the columns, once'''
+        if not self.loaded:
+            self.loaded = True
+            try:
+                dict.update(self,self.fc.key_load_table(self.cblock))
+            except:
+                self.loaded = False
+                raise
+
+    # the column labels are known from the header, without parsing the rows
+    def __len__(self):
+        if self.loaded:
+            return dict.__len__(self)
+        return len(self.cblock.clabels)
+
+    def __contains__(self,colname):
+        if self.loaded:
+            return dict.__contains__(self,colname)
+        return colname in self.cblock.clabels
+
+    def has_key(self,colname):
+        return colname in self
+
+    # everything else needs the values
+    def __getitem__(self,colname):
+        self.load()
+        return dict.__getitem__(self,colname)
+
+    def __setitem__(self,colname,cval):
+        self.load()
+        dict.__setitem__(self,colname,cval)
+
+    def __iter__(self):
+        self.load()
+        return dict.__iter__(self)
+
+    def get(self,colname,default=None):
+        self.load()
+        return dict.get(self,colname,default)
+
+    def setdefault(self,colname,default=None):
+        self.load()
+        return dict.setdefault(self,colname,default)
+
+    def pop(self,colname,*default):
+        self.load()
+        return dict.pop(self,colname,*default)
+
+    def keys(self):
+        self.load()
+        return dict.keys(self)
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+    def items(self):
+        self.load()
+        return dict.items(self)
+
+    def iterkeys(self):
+        self.load()
+        return dict.iterkeys(self)
+
+    def itervalues(self):
+        self.load()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self.load()
+        return dict.iteritems(self)
 
 # ################################################ #
 # Class to hold information about the in/out files #
@@ -219,49 +1586,223 @@ class file_control():
     # ############## #
     # INITIALIZATION #
     # ############## #
-    def __init__(self):
+    def __init__(self,stream_files=False,chunksize=None,nworkers=1,cachedir=None,cachesize=CACHE_SIZE,
+                 validate=True,profile=None,lazy=False,cache=None):
+        # stream_files: check only the headers of external FILE table blocks
+        # at read time and stream their rows, chunksize at a time, on output
+        self.stream_files = stream_files
+        if chunksize is None:
+            chunksize = TABLE_CHUNK
+        self.chunksize = chunksize
+        # nworkers > 1: parse table blocks longer than chunksize rows in a process pool
+        self.nworkers = nworkers
+        # cachedir: reuse parsed blocks whose text (or external file) is unchanged
+        # cache: a block_cache or memory_cache to use instead, shared between file_controls
+        if cache is not None:
+            self.cache = cache
+        elif cachedir is not None:
+            self.cache = block_cache(cachedir,cachesize)
+        else:
+            self.cache = None
+        self.defaults_hash = ''      # hash of key_defaults.txt, part of the keyword block cache keys
+        # validate: check the names referenced between table blocks after reading
+        self.validate = validate
+        # lazy: parse the rows of a KYP table block only when its columns are
+        # first used; the checks of validate then wait for the first write
+        self.lazy = lazy
+        self.checks_pending = False
+        # profile: True or a callback taking each stage record, to time the
+        # stages of read and write; None costs nothing
+        if profile:
+            self.profiler = stage_profiler(profile if callable(profile) else None)
+        else:
+            self.profiler = None
         self.kwblocksall = kwblocks.keys()
         self.kwblocks = dict()        
         self.tabblocksall = tabblocks.keys()
         self.tabblocks = dict()        
-        self.tabblockdict =  tabblockdicts
+        self.tabblockdict = new_tabblockdicts()
 
       
 
     def read(self,fname):
-        '''a convience function to read in the desired type of input'''
-        if fname.upper().endswith('KYP'):
-            self.key_check_block_integrity(fname)
-            self.key_initialize_blocks()
-            self.default_updates()
-            self.key_read_keyword_blocks()
-            self.key_read_table_blocks()
-            self.key_default_enumeration()
-        elif fname.upper().endswith('XML'):
-            self.xml_read(fname)
-            self.key_default_enumeration()
-        else:
+        '''a convience function to read in the desired type of input, which
+        may be compressed (.gz, .bz2 or .xz after the extension)
+        '''
+        fmt = control_format(fname)
+        if fmt not in ('kyp','xml','pst'):
             raise TypeError,'file type '+fname[-3:]+' not supported'
+        if compression_ext(fname):
+            fp = open_compressed(fname,'rb')
+        elif fmt == 'xml':
+            fp = open(fname,'rb')
+        else:
+            fp = open(fname,'r')
+        try:
+            self.read_stream(fp,fmt)
+        finally:
+            fp.close()
         return
 
+    def read_stream(self,src,fmt):
+        '''read input of format fmt ('kyp', 'xml' or 'pst') from a file-like object,
+        or from a string holding the contents of the file
+        '''
+        if isinstance(src,unicode):
+            src = src.encode('utf-8')
+        if isinstance(src,str):
+            src = StringIO(src)
+        if fmt.lower() == 'kyp':
+            self.stage('integrity check',self.key_check_block_integrity,src)
+            self.stage('block initialization',self.key_initialize_blocks)
+            self.stage('default values',self.default_updates)
+            self.stage('keyword read',self.key_read_keyword_blocks)
+            self.stage('table read',self.key_read_table_blocks)
+        elif fmt.lower() == 'xml':
+            self.stage('xml_read',self.xml_read,src)
+        elif fmt.lower() == 'pst':
+            self.stage('pst_read',self.pst_read,src)
+        else:
+            raise TypeError,'file type '+fmt+' not supported'
+        self.checks_pending = self.validate
+        if not (self.lazy and fmt.lower() == 'kyp'):
+            self.run_checks()
+        self.stage('enumeration',self.key_default_enumeration)
+        return
+
+    def run_checks(self):
+        '''check the names and values of the blocks read, if not yet done'''
+        if self.checks_pending:
+            self.checks_pending = False
+            self.stage('unique names',self.check_unique_names)
+            self.stage('references',self.check_references)
+            self.stage('value checks',self.key_check_values)
+
+    def stage(self,name,func,*args):
+        '''run func(*args), recorded as stage name when profiling'''
+        if self.profiler is None:
+            return func(*args)
+        return self.profiler.run(name,self,func,*args)
+
     def write(self,fname):
-        '''a convience function to write out the desire type of output'''
-        if fname.upper().endswith('PST'):
-            self.pst_write(fname)
-        elif fname.upper().endswith('XML'):
-            self.xml_write(fname)
+        '''a convience function to write out the desire type of output, compressed
+        if the name ends in .gz, .bz2 or .xz
+        '''
+        self.run_checks()
+        if control_format(fname) == 'pst':
+            self.stage('pst_write',self.pst_write,fname)
+        elif control_format(fname) == 'xml':
+            self.stage('xml_write',self.xml_write,fname)
         else:
             raise TypeError,'file type '+fname[-3:]+' not supported'
+
+    def write_stream(self,ofp,fmt):
+        '''write output of format fmt ('pst' or 'xml') to a file-like object'''
+        self.run_checks()
+        if fmt.lower() == 'pst':
+            self.stage('pst_write',self.pst_write,ofp)
+        elif fmt.lower() == 'xml':
+            self.stage('xml_write',self.xml_write,ofp)
+        else:
+            raise TypeError,'file type '+fmt+' not supported'
+
+    def write_many(self,fnames,concurrent=None):
+        '''write each of the files in fnames (.pst or .xml) from the blocks read once
+        with concurrent, every file but the first is written by a forked child
+        process while this process writes the first; by default this is done
+        where os.fork is available and there is more than one cpu
+        '''
+        for fname in fnames:
+            if control_format(fname) not in ('pst','xml'):
+                raise TypeError,'file type '+fname[-3:]+' not supported'
+        if concurrent is None:
+            concurrent = hasattr(os,'fork') and len(fnames) > 1 and cpu_count() > 1
+        if not concurrent or len(fnames) < 2:
+            for fname in fnames:
+                self.write(fname)
+            return
+        # everything shared is done here, before the children copy this process
+        self.run_checks()
+        self.tab_load_lazy()
+        sys.stdout.flush()
+        children = list()
+        try:
+            for fname in fnames[1:]:
+                rfd,wfd = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    os.close(rfd)
+                    self.write_child(fname,wfd)
+                os.close(wfd)
+                children.append((pid,rfd))
+            self.write(fnames[0])
+        finally:
+            # collect every child, even after an error here
+            results = list()
+            for pid,rfd in children:
+                rfp = os.fdopen(rfd,'rb')
+                try:
+                    result = cPickle.load(rfp)
+                except EOFError:
+                    result = (False,(OSError,('writer process failed',),dict()))
+                rfp.close()
+                os.waitpid(pid,0)
+                results.append(result)
+        for ok,value in results:
+            if not ok:
+                raise_task_error(value)
+            if self.profiler is not None:
+                self.profiler.records.extend(value)
+
+    def pestpp_socket(self):
+        '''set GMAN_SOCKET of the pest++ block from HOST and PORT as pst_write
+        does, so that the XML file holds it whichever file is written first
+        '''
+        cdict = self.kwblocks.get('pest++')
+        if cdict is None:
+            return
+        cdict = cdict.kwdict
+        if cdict.get('HOST',UNINIT_STRING) == UNINIT_STRING or cdict.get('PORT',UNINIT_INT) == UNINIT_INT:
+            return
+        try:
+            cdict['GMAN_SOCKET'] = str(cdict['HOST']) + ":" + str(int(cdict['PORT']))
+        except ValueError:
+            # reported by pst_write
+            pass
+
+    def write_child(self,fname,wfd):
+        '''in a forked child: write fname, send (True,stage records) or
+        (False,error) through the pipe wfd and leave the process
+        '''
+        try:
+            try:
+                if self.profiler is not None:
+                    self.profiler.records = list()
+                self.write(fname)
+                result = (True,self.profiler.records if self.profiler is not None else None)
+            except Exception as e:
+                result = (False,(e.__class__,e.args,e.__dict__))
+            wfp = os.fdopen(wfd,'wb')
+            cPickle.dump(result,wfp,cPickle.HIGHEST_PROTOCOL)
+            wfp.close()
+            sys.stdout.flush()
+        finally:
+            # never return into the caller of write_many
+            os._exit(0)
         
     def default_updates(self):
         # checks for a custom default values file. If one is present, read all variable values and replace defaults with them
-        cfiles = os.listdir(os.getcwd())
-        for cf in cfiles:
-            if cf.lower() == 'key_defaults.txt':
-                defaults_file = cf
-                break
+        allpairs = self.read_defaults()
+        for i in self.kwblocks:
+            self.apply_defaults(self.kwblocks[i],allpairs)
+
+    def read_defaults(self):
+        # returns a dictionary of the keyword values in key_defaults.txt, empty if there is no such file
+        defaults_file = find_defaults_file()
+        allpairs = dict()
         if defaults_file:
             indat = open(defaults_file,'r').readlines()
+            self.defaults_hash = hashlib.sha1(''.join(indat)).hexdigest()
             allpairs = list()
             for line in indat:
                 tmp = line.split()
@@ -275,31 +1816,34 @@ class file_control():
             cvals = allpairs[1::2]
             # check that they are the same length
             if len(ckeys) != len(cvals):
-                raise(DefaultKeyMismatch())                            
+                raise(DefaultKeyError())                            
             else:
                 allpairs = dict(zip(ckeys,cvals))
-            for i in self.kwblocks:
-                cblock = self.kwblocks[i]
-                # set the list of legal keys
-                legal_keywords = cblock.kwdict.keys()                
-                for ckey in allpairs:
-                    if ckey.upper() in legal_keywords:
-                        cblock.kwdict[ckey.upper()] = allpairs[ckey]
-                    # case especiale for the pesky pareto reporting keywords
-                    elif i == 'pareto':
-                        if 'OBS_REPORT_' in ckey.upper():
-                            cblock.kwdict[ckey.upper()] = allpairs[ckey]                    
+        return allpairs
+
+    def apply_defaults(self,cblock,allpairs):
+        # replace the defaults of a keyword block with those read by read_defaults
+        # set the list of legal keys
+        legal_keywords = cblock.kwdict.keys()                
+        for ckey in allpairs:
+            if ckey.upper() in legal_keywords:
+                cblock.kwdict[ckey.upper()] = allpairs[ckey]
+            # case especiale for the pesky pareto reporting keywords
+            elif cblock.blockname == 'pareto':
+                if 'OBS_REPORT_' in ckey.upper():
+                    cblock.kwdict[ckey.upper()] = allpairs[ckey]                    
         
         
     def default_enumeration_guts(self,tab_block_name,kw_block_name,par_name,length_par,replaced_text):
         # convenience function used by key_default_enumeration function
-        if len(self.tabblockdict[tab_block_name][length_par]) != int(self.kwblocks[kw_block_name].kwdict[par_name]):
+        nrow = self.tab_nrow(tab_block_name,length_par)
+        if nrow != int(self.kwblocks[kw_block_name].kwdict[par_name]):
             if self.kwblocks[kw_block_name].kwdict[par_name] != UNINIT_INT:
                 print 'Warning: %s specified as %s: Replaced with actual %s --> %d' %(par_name,
                                                                                     self.kwblocks[kw_block_name].kwdict[par_name],
                                                                                     replaced_text,
-                                                                                    len(self.tabblockdict[tab_block_name][length_par]))
-            self.kwblocks[kw_block_name].kwdict[par_name] = len(self.tabblockdict[tab_block_name][length_par]) 
+                                                                                    nrow)
+            self.kwblocks[kw_block_name].kwdict[par_name] = nrow 
     
     def key_default_enumeration(self):
         # function to provide counts for enumerated values to avoid misstated counters
@@ -319,7 +1863,7 @@ class file_control():
         try:
             self.default_enumeration_guts('model_command_line','control_data','NUMCOM','COMLINE','number of command line calls')   
         except KeyError:
-            self.kwblocks['control_data'].kwdict['NUMCOM'] = len(self.tabblockdict['model_command_line']['COMLINE']) 
+            self.kwblocks['control_data'].kwdict['NUMCOM'] = self.tab_nrow('model_command_line','COMLINE') 
         #NPRIOR --> special case needs an error trap
         if int(self.kwblocks['control_data'].kwdict['NPRIOR']) != 0:
             try:
@@ -328,311 +1872,282 @@ class file_control():
                 print 'Warning: NPRIOR specified as %s: No prior information supplied. NPRIOR set to 0.' %(self.kwblocks['control_data'].kwdict['NPRIOR'])
                 
     def xml_write(self,fname):
-        #--instance of an XML tree
-        root = xml.Element('pcf')
-        #--keyword blocks - easy               
-        temp = []
-        for name in self.kwblocks.keys():
-            section = self.xml_write_kwBlock(name,block_text=jup2pst[name])
-            #--make sure control section is first - no reason really
-            if name == 'control_data':
-                root.append(section)
-            else:
-                temp.append(section)
-        for t in temp:
-            root.append(t)
-        
-        #--table blocks - less easy
-        partied_section = None
-        for name in self.tabblockdict.keys():            
-                section = self.xml_write_tblBlock(name,block_text=jup2pst[name])
-                if section is not None and name is not 'parameter_tied_data':
-                    #-- check for duplicate sections - model i/o mess
-                    isDup = False
-                    for ssection in root:                        
-                        if ssection.text == section.text:
-                            for element in section:
-                                ssection.append(element)
-                            isDup = True
-                            break
-                    if not isDup:
-                        root.append(section)
-
-                elif section is not None and name is 'parameter_tied_data':
-                    partied_section = section
-        
-        #--tied parameter mess
-        if partied_section is not None:
-            #--find the parameter data section            
-            par_section = None
-            for section in root:
-                if section.text == '* parameter data':
-                    par_section = section
+        '''write the XML file section by section straight to disk, in the
+        layout ElementTree gave the indented tree, so that table blocks are
+        never held as elements in memory
+        '''
+        if not hasattr(fname,'write'):
+            return write_output(self.xml_write,fname)
+        ofp = fname
+        self.pestpp_socket()
+        #--keyword blocks - control section first - no reason really
+        kwnames = self.kwblocks.keys()
+        if 'control_data' in kwnames:
+            kwnames.remove('control_data')
+            kwnames.insert(0,'control_data')
+        #--table blocks - model input and output share a section
+        sections = list()
+        for name in self.tabblockdict.keys():
+            if name == 'parameter_tied_data' or self.tab_isempty(name):
+                continue
+            for text,names in sections:
+                if text == jup2pst[name]:
+                    names.append(name)
                     break
-            #--for each parameter entry
-            for par_entry in par_section:
-                #--for each tied parameter entry:
-                for tied_entry in partied_section:                    
-                    if tied_entry.tag == par_entry.tag:
-                        #--get the value of the 'partied' attribute
-                        partied_val = tied_entry.find('PARTIED').attrib['value']                                                
-                        #--find the partied element of the parameter entry and add the value attribute
-                        par_entry.find('PARTIED').set('value',partied_val)
-                        break                                                                       
-        
-        #--write the XML file - crazy easy
-        self.xml_indent(root)
-        xml.ElementTree(root).write(fname)
+            else:
+                sections.append((jup2pst[name],[name]))
+        #--tied parameter mess: PARTIED values of the parameter data rows
+        partied = dict()
+        if 'parameter_tied_data' in self.tabblockdict and not self.tab_isempty('parameter_tied_data'):
+            for cdict in self.tab_chunks('parameter_tied_data'):
+                for parnme,ctied in izip(cdict[table2tag['parameter_tied_data']],cdict['PARTIED']):
+                    partied.setdefault(parnme,str(ctied))
+
+        if len(kwnames) + len(sections) == 0:
+            ofp.write('<pcf />')
+            return
+        ofp.write('<pcf>')
+        for name in kwnames:
+            self.xml_write_kwBlock(ofp,name,block_text=jup2pst[name])
+        for text,names in sections:
+            ofp.write('\n  <section>' + xml_escape_cdata(text))
+            nrow = 0
+            for name in names:
+                for cdict in self.tab_chunks(name):
+                    nrow += self.xml_write_tblBlock(ofp,name,cdict,partied)
+            if nrow > 0:
+                ofp.write('\n  </section>')
+            else:
+                ofp.write('</section>')
+        ofp.write('\n</pcf>\n')
         return
 
-    def xml_write_tblBlock(self,block_name,block_text=''):
-        '''write a table block to an XML element        
+    def xml_write_tblBlock(self,ofp,block_name,cdict,partied):
+        '''write the rows of a chunk of a table block as XML elements
+        sub-elements are sorted by tag; returns the number of rows written
         '''
-        section = None
-        block_dict = self.tabblockdict[block_name]             
-        if len(block_dict.keys()) > 0:
-            section = xml.Element('section')
-            section.text = block_text   
-            for i,pdict in enumerate(block_dict[block_dict.keys()[0]]):
-                tag = block_dict[table2tag[block_name]][i]
-                entry = xml.Element(tag) 
-                #--use temp as container that can be sorted
-                temp = []
-                for k,v in block_dict.iteritems():
-                    sub_entry = xml.Element(k)
-                    if v[i] not in UNINIT:
-                        sub_entry.set('value',str(v[i]))
-                    temp.append((k,sub_entry))
-                
-                #--if this is the parameter data section, add a partied element
-                if block_name == 'parameter_data':
-                    temp.append(('PARTIED',xml.Element('PARTIED')))
-
-                #--sort and add sub-elements to entry
-                temp.sort()
-                for t in temp:
-                    entry.append(t[1]) 
-                section.append(copy.deepcopy(entry))                                                                          
-        return section
-
-    def xml_write_kwBlock(self,block_name,block_text=''):
-        '''write a keyword block to an XML element
+        tags = cdict[table2tag[block_name]]
+        #--a prior information row is tagged by its label, the first word of the line
+        if block_name == 'prior_information':
+            tags = [str(t).split(None,1)[0] for t in tags]
+        colnames = cdict.keys()
+        #--if this is the parameter data section, add a partied element
+        if block_name == 'parameter_data':
+            colnames.append('PARTIED')
+        colnames.sort()
+        nrow = len(tags)
+        for start in xrange(0,nrow,WRITE_CHUNK):
+            ctags = tags[start:start+WRITE_CHUNK]
+            xtags = xml_tags(ctags)
+            ccols = [['\n    <' + t + '>' for t in xtags]]
+            for k in colnames:
+                if k == 'PARTIED' and block_name == 'parameter_data':
+                    cvals = [partied.get(t,UNINIT_STRING) for t in ctags]
+                else:
+                    cvals = cdict[k][start:start+WRITE_CHUNK]
+                ccols.append(xml_write_col(k,cvals))
+            ccols.append(['\n    </' + t + '>' for t in xtags])
+            ofp.write(''.join(imap(''.join,izip(*ccols))))
+        return nrow
+
+    def xml_write_kwBlock(self,ofp,block_name,block_text=''):
+        '''write a keyword block as an XML section
         sorts the subelements by tag
         '''
         block_dict = self.kwblocks[block_name].kwdict
-        section = xml.Element('section')
-        section.text = block_text
-        temp = []
-        for k,v in block_dict.iteritems():            
-            entry = xml.Element(k)
-            if v not in UNINIT:
-                entry.set('value',str(v))
-            #section.append(entry) 
-            temp.append((k,entry))
-        temp.sort()
-        for t in temp:
-            section.append(t[1])
-        return section
-
-    def xml_indent(self,elem,level=0):
-        '''for prettyprinting XML
-        '''
-        i = "\n" + level*"  "
-        if len(elem):        
-        
-            if not elem.text or not elem.text.strip():
-            #try:
-            #    elem.text += i + "  "
-            #except TypeError:
-                elem.text = i + "  "
-            else:
-                elem.text += i + "  "                            
-            if (not elem.tail or not elem.tail.strip()) :
-                elem.tail = i
-            for elem in elem:
-                self.xml_indent(elem, level+1)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
+        ofp.write('\n  <section>' + xml_escape_cdata(block_text))
+        for k in sorted(block_dict):
+            ofp.write(xml_write_col(k,[block_dict[k]],indent='\n    ')[0])
+        if len(block_dict) > 0:
+            ofp.write('\n  </section>')
         else:
-            if level and (not elem.tail or not elem.tail.strip()):
-                elem.tail = i
-                
-    def xml_read(self,fname):        
-        #--load the xml tree
-        tree = xml.parse(fname) 
-        root = tree.getroot()
-        #--initialize the keyword and table blocks needed
-        self.xml_initialize(root)
-        #--update the default values
-        self.default_updates()
-        #--fill the blocks
-        self.xml_fill(root)
-                          
-        return
+            ofp.write('</section>')
 
-    def xml_fill(self,root):
-        '''fill the file_control object from the xml tree
+    def xml_read(self,fname):
+        '''read an XML control file (a name or a file-like object) in a single
+        iterparse pass; blocks are created as their sections are reached, table
+        values go straight into typed column buffers and each entry is dropped once used
         '''
-        #--a list for the tied paramter mess
-        tied_list = []
-        for section in root:
-            #--cast the element text to a jupiter block tag
-            jup_text = '_'.join(section.text.split()[1:])
-            
-            #--fill the keyword blocks - easy           
-            if jup_text in self.kwblocks:                            
-                for entry in section:                   
-                    if 'value' in entry.attrib.keys():
-                        self.kwblocks[jup_text].kwdict[entry.tag] = entry.attrib['value']
-            
-            #--fill the table block - less easy            
-            elif jup_text in self.tabblocksall:                
-                #--check for a 'spreadsheet' element
-                xls_entry = section.find('SPREADSHEET')
-                if xls_entry is not None:
-                    fname = xls_entry.attrib['file']
-                    if fname.upper().endswith('XLSX'):
-                        raise TypeError,'Only XLS EXCEL files are supported, resave as EXCEL 97-2003 workbook'
-                    elif fname.upper().endswith('XLS'):
-                        self.read_xls_table(fname,self.tabblocks[jup_text])
-                    else:
-                        raise TypeError,'Unrecognized extension for spreadsheet file: '+fname
-
-
-                #--for each row in the table                    
-                for entry in section:
-                    isParam,isTied = self.xml_paramtied(entry)
-                    if isParam:                            
-                        partied = entry.find('PARTIED')
-                        if isTied:
-                            partied_val = partied.attrib['value']
-                            tied_list.append([entry.tag,partied_val])
-                        entry.remove(partied)
-                    #--for each (possible) column in the table                        
-                    for subentry in entry:                  
-                        #-- if this subentry has a value attribute                                      
-                        if 'value' in subentry.attrib.keys():                                                            
-                            #-- if this key already exists, append
-                            if subentry.tag in self.tabblockdict[jup_text].keys():
-                                self.tabblockdict[jup_text][subentry.tag].append(subentry.attrib['value'])
-                            #--otherwise, create a list for this key
-                            else:                                   
-                                self.tabblockdict[jup_text][subentry.tag] = [subentry.attrib['value']]
-                                 
-            
-            #--'model_input' and 'model_output' need special treatment
-            else:    
-                #--find the model interface tag
-                for i,entry in enumerate(section):
-                    inter_entry = entry.find('MODEL_INTERFACE_FILE')
-                    file_entry = entry.find('MODEL_FILE')                                                                                
-                    
-                    #--which key - TPL or INS?
-                    if inter_entry.attrib['value'].upper().endswith('TPL'):
-                        kkey = 'model_input'
-                        inter_file = 'TEMPFLE'
-                        model_file = 'INFLE'
-                    else:
-                        kkey = 'model_output'
-                        inter_file = 'INSFLE'
-                        model_file = 'OUTFLE'
-                    #--if this key already exists, append
-                    if inter_file in self.tabblockdict[kkey].keys():
-                        self.tabblockdict[kkey][inter_file].append(inter_entry.attrib['value']) 
-                        self.tabblockdict[kkey][model_file].append(file_entry.attrib['value']) 
-                    #--else, create a list for this key
-                    else:
-                        self.tabblockdict[kkey][inter_file] = [inter_entry.attrib['value']]
-                        self.tabblockdict[kkey][model_file] = [file_entry.attrib['value']] 
-                                                                                                         
-        #--add the tied parameter junk
-        if tied_list:
-            self.tabblockdict['parameter_tied_data']['PARNME'] = []
-            self.tabblockdict['parameter_tied_data']['PARTIED'] = []
-            for t in tied_list:
-                self.tabblockdict['parameter_tied_data']['PARNME'].append(t[0])
-                self.tabblockdict['parameter_tied_data']['PARTIED'].append(t[1])
+        if isinstance(fname,basestring):
+            # a name is opened here, decompressed as it is read if need be
+            fp = open_compressed(fname,'rb')
+            try:
+                return self.xml_read(fp)
+            finally:
+                fp.close()
+        import numpy as np
+        try:
+            import xml.etree.cElementTree as xml
+        except ImportError:
+            import xml.etree.ElementTree as xml
+        defaults = self.read_defaults()
+        #--lists for the tied paramter mess
+        self.xml_tied = ([],[])
+        depth = 0
+        for event,elem in xml.iterparse(fname,events=('start','end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = elem
+                elif depth == 2:
+                    section = elem
+                    jup_text = None
+                elif depth == 3 and jup_text is None:
+                    #--the section text is complete once its first entry starts
+                    jup_text = self.xml_initialize(section.text,defaults)
+                continue
+            depth -= 1
+            if depth == 2:
+                self.xml_fill(jup_text,elem)
+                section.remove(elem)
+            elif depth == 1:
+                if jup_text is None:
+                    jup_text = self.xml_initialize(section.text,defaults)
+                root.remove(section)
 
+        #--turn the column buffers into arrays
+        for name,block_dict in self.tabblockdict.iteritems():
+            for k,v in block_dict.items():
+                if isinstance(v,column_buffer):
+                    block_dict[k] = v.array()
+        #--add the tied parameter junk
+        if self.xml_tied[0]:
+            self.tabblockdict['parameter_tied_data']['PARNME'] = np.array(self.xml_tied[0],dtype=object)
+            self.tabblockdict['parameter_tied_data']['PARTIED'] = np.array(self.xml_tied[1],dtype=object)
+        del self.xml_tied
         #--cast the pi attributes to string
-        self.xml_pi2string()                
+        self.xml_pi2string()
         return
 
-    
-    def xml_pi2string(self):
-        if 'prior_information' in self.tabblockdict.keys():
-            self.tabblockdict['prior_information']['PILINES'] = []
-            pi_dict = self.tabblockdict['prior_information']                
-            for i,pi_line in enumerate(pi_dict['PILBL']):
-                pi_str = pi_dict['PILBL'][i] + ' '+ pi_dict['PI_EQUATION'][i] + ' ' + pi_dict['WEIGHT'][i] + ' ' + pi_dict['OBGNME'][i]
-                self.tabblockdict['prior_information']['PILINES'].append(pi_str)           
-        return
-      
-    def xml_paramtied(self,entry):
-        '''checks if entry is a parameter entry and also if it is tied
-        returns isParam[bool],isTied[bool]
+    def xml_initialize(self,text,defaults):
+        '''initialize the block for a section from its text and return the
+        block name, 'model_input/output' for the shared model i/o section
         '''
-        partrans = entry.find('PARTRANS')
-        if partrans is None:
-            return False,False
-        partrans_val = partrans.attrib['value']
-        if partrans_val.upper() == 'TIED':
-            return True,True
+        #--cast the element text to a jupiter block tag
+        ctext = text.split()
+        if ctext == ['pest++']:
+            jup_text = 'pest++'
         else:
-            return True,False                                    
+            jup_text = '_'.join(ctext[1:])
+
+        #--this is a keyword block
+        if jup_text in self.kwblocksall:
+            #--there can only be one of each keyword block
+            if jup_text in self.kwblocks:
+                raise TypeError,'duplicate keyword block found: '+jup_text
+            self.kwblocks[jup_text] = kw(jup_text,dict(kwblocks[jup_text]))
+            self.apply_defaults(self.kwblocks[jup_text],defaults)
 
-    def xml_initialize(self,root):
-        '''initialize the keyword and table blocks present in the
-        xml tree
+        #-- this is a table block
+        elif jup_text in self.tabblocksall:
+            #--there can only be one of each table block
+            if jup_text in self.tabblocks:
+                raise TypeError,'duplicate table block found: '+jup_text
+            self.tabblocks[jup_text] = tb(jup_text,tabblocks[jup_text])
 
-        special treatment of the model i/o block and the tied parameter mess
+        #--'model_input' and 'model_output' are created by their entries
+        elif jup_text != 'model_input/output':
+            raise TypeError,'unidentified block in XML file: '+jup_text
+        return jup_text
 
+    def xml_fill(self,jup_text,entry):
+        '''fill the block jup_text from one entry of its section
         '''
-        for section in root:
-            #--cast the element text to a jupiter block tag
-            jup_text = '_'.join(section.text.split()[1:])
-            
-            #--this is a keyword block
-            if jup_text in self.kwblocksall:
-                #--there can only be one of each keyword block
-                if jup_text in self.kwblocks.keys():
-                    raise TypeError,'duplicate keyword block found: '+jup_text                
-                self.kwblocks[jup_text]=kw(jup_text,kwblocks[jup_text])                
-               
-            #-- this is a table block
-            elif jup_text in self.tabblocksall:
-                #--there can only be one of each table block?
-                if jup_text in self.kwblocks.keys():
-                    raise TypeError,'duplicate table block found: '+jup_text
-                #--need a partied section?
-                if jup_text.upper() == 'PARAMETER_DATA':                    
-                    for entry in section:                        
-                        isParam,isTied = self.xml_paramtied(entry)
-                        if isTied:
-                            break
-                    if isTied:
-                        self.tabblocks['parameter_tied_data'] = tb('parameter_tied_data',tabblocks['parameter_tied_data'])                
-                self.tabblocks[jup_text] = tb(jup_text,tabblocks[jup_text])                
-            
-            #--'model_input' and 'model_output' need special treatment
-            else:    
-                #--find the model interface tag
-                for i,entry in enumerate(section):
-                    mod_inter = entry.find('MODEL_INTERFACE_FILE')
-                    
-                    #--if the model inteface tag was not found
-                    if mod_inter is None:
-                        raise TypeError,'unidentified block in XML file: '+jup_text
-                
-                    mod_inter_file = mod_inter.attrib['value']
-                    if mod_inter_file.upper().endswith('TPL'):
-                        self.tabblocks['model_input'] = tb('model_input',tabblocks['model_input'])    
-                    elif mod_inter_file.upper().endswith('INS'):
-                        self.tabblocks['model_output'] = tb('model_output',tabblocks['model_output'])    
-                    else:
-                        raise TypeError,'unidentified model interface file'+mod_inter_file
-                            
+        #--fill the keyword blocks - easy
+        if jup_text in self.kwblocks:
+            if 'value' in entry.attrib:
+                self.kwblocks[jup_text].kwdict[entry.tag] = entry.attrib['value']
+            return
+
+        #--'model_input' and 'model_output' need special treatment
+        if jup_text == 'model_input/output':
+            self.xml_fill_modelio(entry)
+            return
+
+        #--check for a 'spreadsheet' element
+        if entry.tag == 'SPREADSHEET':
+            fname = entry.attrib['file']
+            if fname.upper().endswith('XLSX'):
+                raise TypeError,'Only XLS EXCEL files are supported, resave as EXCEL 97-2003 workbook'
+            elif fname.upper().endswith('XLS'):
+                self.read_xls_table(fname,self.tabblocks[jup_text])
+            else:
+                raise TypeError,'Unrecognized extension for spreadsheet file: '+fname
+            return
+
+        #--parameters carry their tied parameter, if any, in PARTIED
+        partrans = entry.find('PARTRANS')
+        if partrans is not None:
+            partied = entry.find('PARTIED')
+            if partrans.attrib['value'].upper() == 'TIED':
+                if 'parameter_tied_data' not in self.tabblocks:
+                    self.tabblocks['parameter_tied_data'] = tb('parameter_tied_data',tabblocks['parameter_tied_data'])
+                #--the tag may have been changed to make it valid XML
+                parnme = entry.find('PARNME')
+                self.xml_tied[0].append(entry.tag if parnme is None else parnme.attrib['value'])
+                self.xml_tied[1].append(partied.attrib['value'])
+            if partied is not None:
+                entry.remove(partied)
+
+        #--for each (possible) column in the table
+        block_dict = self.tabblockdict[jup_text]
+        for subentry in entry:
+            if 'value' in subentry.attrib:
+                try:
+                    cbuf = block_dict[subentry.tag]
+                except KeyError:
+                    cbuf = block_dict[subentry.tag] = column_buffer(
+                        tabcoltypes.get(jup_text,dict()).get(subentry.tag,'string'),jup_text,subentry.tag)
+                cbuf.append(subentry.attrib['value'])
+
+    def xml_fill_modelio(self,entry):
+        '''add a row to model_input or model_output, written either with
+        MODEL_INTERFACE_FILE/MODEL_FILE or with the PST column names
+        '''
+        inter_entry = entry.find('MODEL_INTERFACE_FILE')
+        if inter_entry is not None:
+            file_entry = entry.find('MODEL_FILE')
+            #--which key - TPL or INS?
+            if inter_entry.attrib['value'].upper().endswith('TPL'):
+                kkey,inter_file,model_file = 'model_input','TEMPFLE','INFLE'
+            elif inter_entry.attrib['value'].upper().endswith('INS'):
+                kkey,inter_file,model_file = 'model_output','INSFLE','OUTFLE'
+            else:
+                raise TypeError,'unidentified model interface file'+inter_entry.attrib['value']
+        elif entry.find('TEMPFLE') is not None:
+            kkey,inter_file,model_file = 'model_input','TEMPFLE','INFLE'
+            inter_entry,file_entry = entry.find(inter_file),entry.find(model_file)
+        elif entry.find('INSFLE') is not None:
+            kkey,inter_file,model_file = 'model_output','INSFLE','OUTFLE'
+            inter_entry,file_entry = entry.find(inter_file),entry.find(model_file)
+        else:
+            raise TypeError,'unidentified block in XML file: model_input/output'
+        if kkey not in self.tabblocks:
+            self.tabblocks[kkey] = tb(kkey,tabblocks[kkey])
+        block_dict = self.tabblockdict[kkey]
+        #--if this key already exists, append
+        if inter_file in block_dict:
+            block_dict[inter_file].append(inter_entry.attrib['value'])
+            block_dict[model_file].append(file_entry.attrib['value'])
+        #--else, create a buffer for this key
+        else:
+            block_dict[inter_file] = column_buffer('string',kkey,inter_file)
+            block_dict[inter_file].append(inter_entry.attrib['value'])
+            block_dict[model_file] = column_buffer('string',kkey,model_file)
+            block_dict[model_file].append(file_entry.attrib['value'])
+
+    def xml_pi2string(self):
+        '''join the PILBL, PI_EQUATION, WEIGHT and OBGNME entries into PILINES'''
+        import numpy as np
+        pi_dict = self.tabblockdict.get('prior_information',dict())
+        if 'PILBL' in pi_dict:
+            pilines = list()
+            for i,pi_line in enumerate(pi_dict['PILBL']):
+                pi_str = pi_dict['PILBL'][i] + ' '+ pi_dict['PI_EQUATION'][i] + ' ' + pi_dict['WEIGHT'][i] + ' ' + pi_dict['OBGNME'][i]
+                pilines.append(pi_str)
+            pi_dict['PILINES'] = np.array(pilines,dtype=object)
         return
-    
+
     def read_xls_table(self,fname,block):
         #--open the workbook
         wb = xlrd.open_workbook(fname)
@@ -668,156 +2183,108 @@ class file_control():
             if hasHeader:
                 col = col[1:]            
             head = header[i]
-            self.tabblockdict[block.blockname][head] = col
+            self.tabblockdict[block.blockname][head] = cast_column(col,
+                                                                   tabcoltypes.get(block.blockname,dict()).get(head,'string'),
+                                                                   block.blockname,head,2 if hasHeader else 1)
             print              
 
         return []
 
-    # ################################################### #
-    # Learn block names, bomb on duplicates or bad syntax #
-    # ################################################### #
+    # ############################################################################ #
+    # Index all blocks in a single pass, bomb on duplicates, nesting or bad syntax #
+    # ############################################################################ #
     def key_check_block_integrity(self,infile):
-        self.indat = open(infile,'r').readlines()
-        cline = -1
-        # first find all block names and types
+        # infile is a file name or a file-like object
+        if hasattr(infile,'readlines'):
+            self.indat = infile.readlines()
+        else:
+            fp = open_compressed(infile,'r')
+            try:
+                self.indat = fp.readlines()
+            finally:
+                fp.close()
+        # first find all block names and types - each line is tokenized at most once
         allbegins = list()
         allends = list()
-        for line in self.indat:
-            cline += 1
-            tmp = line.lower().strip().split()
+        for cline,line in enumerate(self.indat):
+            low = line.lower()
+            # cheap substring test so that only candidate lines get split
+            if ('begin' not in low) and ('end' not in low):
+                continue
+            tmp = low.split()
             if 'begin' in tmp:
-                if len(tmp) > 3:
+                if len(tmp) > 3 or len(tmp) < 2:
                     raise(BlockSyntaxError(cline))
                 if 'keywords' in tmp:
                     allbegins.append([cline,tmp[1],'kw'])
                 elif 'table' in tmp:
                     allbegins.append([cline,tmp[1],'tab'])
                 elif 'file' in tmp:
-                    allbegins.append([cline,tmp[1],'tab'])
+                    allbegins.append([cline,tmp[1],'file'])
                 else:
                     raise(BlockSyntaxError(cline))
             elif 'end' in tmp:
-                if len(tmp) > 2:
+                if len(tmp) != 2:
                     raise(BlockSyntaxError(cline))
                 else:
                     allends.append([cline,tmp[1]])
-        allbegins = np.array(allbegins)
-        allends = np.array(allends)
 
         # now check that there are no duplicates
-        kwbegins = allbegins[np.nonzero(allbegins[:,2]=='kw')[0]]
-        eunichkwbegins = np.unique(kwbegins[:,1])
-        tabbegins = allbegins[np.nonzero(allbegins[:,2]=='tab')[0]]
-        eunichtabbegins = np.unique(tabbegins[:,1])
-
-        # run dedupe function to identify dupes
-        kwbegin_dupes = dedupe(kwbegins[:,1],eunichkwbegins) 
-        tabbegin_dupes = dedupe(tabbegins[:,1],eunichtabbegins) 
-        end_dupes = dedupe(allends[:,1],np.unique(allends[:,1]))
         dupes = []
-        if len(kwbegin_dupes) > 0:
-            dupes.extend(kwbegin_dupes)
-        if len(tabbegin_dupes) > 0:
-            dupes.extend(tabbegin_dupes)
-        if len(end_dupes) > 0 :
-            dupes.extend(end_dupes)
-        dupes = np.unique(np.array(dupes))
+        for cblocks in ([cb for cb in allbegins if cb[2] == 'kw'],
+                        [cb for cb in allbegins if cb[2] != 'kw'],
+                        allends):
+            for cname,idx in find_dupes([cb[1] for cb in cblocks]):
+                dupes.append((cname,[cblocks[j][0] for j in idx]))
         if len(dupes) > 0:
             raise(BlockDuplicate(dupes))
-    # ################################################################## #
-    # Set starting and ending row numbers, bomb on wrongly nested blocks #
-    # ################################################################## #
-    def key_initialize_blocks(self):        
-        cline = -1
-        # read through and create the block classes, just finding BEGINs of blocks
-        for line in self.indat:    
-            cline += 1
-            tmp = line.lower().strip().split()
-            if 'begin' in tmp:
-                if len(tmp) > 3:
-                    raise(BlockSyntaxError(cline))
-                if 'keywords' in tmp:
-                    if tmp[1] in self.kwblocksall:
-                        self.kwblocks[tmp[1]]=kw(tmp[1],
-                                                 kwblocks[tmp[1]],
-                                                 blockstart=cline)
-                    else:
-                        raise(BlockNameError(cline,tmp[1]))
-                elif 'table' in tmp:
-                    if tmp[1] in self.tabblocksall:
-                        self.tabblocks[tmp[1]] = tb(tmp[1],
-                                                    tabblocks[tmp[1]],
-                                                    blockstart=cline)
-                    else:
-                        raise(BlockNameError(cline,tmp[1]))
-                elif 'file' in tmp:
-                    if tmp[1] in self.tabblocksall:
-                        self.tabblocks[tmp[1]] = tb(tmp[1],
-                                                    tabblocks[tmp[1]],
-                                                    blockstart=cline)
-                    else:
-                        raise(BlockNameError(cline,tmp[1]))
-        allkeynames = self.kwblocks.keys()
-        alltabnames = self.tabblocks.keys()
 
-        # read through and add END line numbers
-        cline = -1
-        for line in self.indat:    
-            cline += 1
-            tmp = line.lower().strip().split()
-            if 'end' in tmp:
-                if len(tmp) > 2:
-                    raise(BlockSyntaxError(cline))
-                if tmp[1] in allkeynames:
-                    self.kwblocks[tmp[1]].blockend = cline
-                elif tmp[1] in alltabnames:
-                    self.tabblocks[tmp[1]].blockend = cline
-                else:
-                    raise(BlockMismatchNoBEGIN(tmp[1]))
-
-        # check for blocks that start without end 
-        for cb in self.kwblocks:
-            if self.kwblocks[cb].blockend == 0:
-                raise(BlockMismatchNoBEGIN(cb))
-            elif self.kwblocks[cb].blockend <= self.kwblocks[cb].blockstart:
-                raise(BlockReversed(cb))
-
-        for cb in self.tabblocks:
-            if self.tabblocks[cb].blockend == 0:
-                raise(BlockMismatchNoBEGIN(cb))
-            elif self.tabblocks[cb].blockend <= self.tabblocks[cb].blockstart:
-                raise(BlockReversed(cb))        
-        # check or blocks that end before they start
+        # build the block index, pairing each BEGIN with its END
+        self.blockindex = dict()
+        for cline,cname,ctype in allbegins:
+            self.blockindex[cname] = blockinfo(cname,ctype,cline)
+        for cline,cname in allends:
+            if cname not in self.blockindex:
+                raise(BlockMismatchNoBEGIN(cname))
+            self.blockindex[cname].blockend = cline
+
+        # check for blocks that start without end or end before they start
+        allblocks = sorted(self.blockindex.values(),key=lambda cb: cb.blockstart)
+        for cb in allblocks:
+            if cb.blockend < 0:
+                raise(BlockMismatchNoEND(cb.blockname))
+            elif cb.blockend <= cb.blockstart:
+                raise(BlockReversed(cb.blockname))
 
         # finally, make sure there are no blocks inside other blocks
-        dumbcheck = []
-        dumbchecknames = []
-        # get an array of starting and ending line numbers 
-        for i,v in enumerate(self.kwblocks):
-            dumbchecknames.append([v])
-            dumbcheck.append([self.kwblocks[v].blockstart,
-                              self.kwblocks[v].blockend,
-                              i])
-        for i,v in enumerate(self.tabblocks):
-            dumbchecknames.append([v])
-            dumbcheck.append([self.tabblocks[v].blockstart,
-                              self.tabblocks[v].blockend,
-                              i])
-        dumbcheck = np.array(dumbcheck)
-        dumbcheck = dumbcheck[dumbcheck[:,0].argsort()]
-        # easy check first
-        dc = dumbcheck[:,[0,1]].reshape(dumbcheck.shape[0]*2,1)
-        dds = np.diff(np.squeeze(dc))
-        if np.min(dds > 0):
-            return # all good
-        else:
-            # now got to figure out where the dumbness occurs
-            for i in np.arange(1,len(dumbcheck)):
-                if dumbcheck[i,0] <= dumbcheck[i-1,1]:
-                    insidenm = dumbchecknames[dumbcheck[i,2]][0]
-                    outsidenm = dumbchecknames[dumbcheck[i-1,2]][0]
-                    raise(BlockIllegalNesting(insidenm,outsidenm))
-        print i
+        for i in xrange(1,len(allblocks)):
+            if allblocks[i].blockstart <= allblocks[i-1].blockend:
+                raise(BlockIllegalNesting(allblocks[i].blockname,allblocks[i-1].blockname))
+
+    # ################################################################ #
+    # Create the keyword and table blocks from the indexed block lines #
+    # ################################################################ #
+    def key_initialize_blocks(self):        
+        # blocks are created in file order so the first illegal name is reported
+        for cb in sorted(self.blockindex.values(),key=lambda cb: cb.blockstart):
+            if cb.blocktype == 'kw':
+                if cb.blockname in self.kwblocksall:
+                    self.kwblocks[cb.blockname]=kw(cb.blockname,
+                                                   dict(kwblocks[cb.blockname]),
+                                                   blockstart=cb.blockstart,
+                                                   blockend=cb.blockend)
+                else:
+                    raise(BlockNameError(cb.blockstart,cb.blockname))
+            else:
+                if cb.blockname in self.tabblocksall:
+                    self.tabblocks[cb.blockname] = tb(cb.blockname,
+                                                      tabblocks[cb.blockname],
+                                                      blockstart=cb.blockstart,
+                                                      blockend=cb.blockend,
+                                                      blocktype=cb.blocktype)
+                else:
+                    raise(BlockNameError(cb.blockstart,cb.blockname))
+
     # ################################################# #
     # read each keyword block and populate the keywords #
     # ################################################# #
@@ -829,6 +2296,12 @@ class file_control():
             legal_keywords = cblock.kwdict.keys()
             #read between the boundaries of the block
             cbdata = self.indat[cblock.blockstart+1:cblock.blockend]
+            if self.cache is not None:
+                cachekey = self.cache.key('kw',i,self.defaults_hash,''.join(cbdata))
+                kwdict = self.cache.get(cachekey)
+                if kwdict is not None:
+                    cblock.kwdict = kwdict
+                    continue
             # make an extended list alternating between KEY and VAL
             allpairs = list()
             for line in cbdata:
@@ -855,10 +2328,14 @@ class file_control():
                 elif i == 'pareto':
                     if 'OBS_REPORT_' in ckey.upper():
                         cblock.kwdict[ckey.upper()] = allpairs[ckey]    
+            if self.cache is not None:
+                self.cache.put(cachekey,cblock.kwdict)
     # ########################################### #
     # read each table block and populate the data #
     # ########################################### #
     def key_read_table_blocks(self):
+        # blocks left for the worker pool when nworkers > 1
+        pending = list()
         for i in self.tabblocks:
             # cblock is shorthand for the current block
             cblock = self.tabblocks[i]
@@ -866,7 +2343,7 @@ class file_control():
             legal_columns = cblock.colnames
             # ## handle external files ability, including XLS
             isExcel = False
-            if 'file' in self.indat[cblock.blockstart].lower():
+            if cblock.blocktype == 'file':
                 tmp1 = []               
                 tmp = self.indat[cblock.blockstart+1:cblock.blockend]
                 for line in tmp:
@@ -880,6 +2357,7 @@ class file_control():
                     if tmp1[0].strip().upper().endswith('XLSX'):
                         raise TypeError,'Only .XLS EXCEL files are supported, resave as EXCEL 97-2003 workbook'
                     elif tmp1[0].strip().upper().endswith('XLS'):
+                        cblock.extfile = tmp1[0].strip()
                         self.read_xls_table(tmp1[0].strip(),cblock)
                         isExcel = True
                         try:
@@ -888,86 +2366,753 @@ class file_control():
                             print 'You need to get the \'XLRD\' module to use the'+\
                                   ' keyPEST EXCEL support functionality'
                             sys.exit()                         
+                    elif control_format(tmp1[0].strip()) in ('npz','npy'):
+                        # columns saved as arrays are loaded, not parsed
+                        cblock.extfile = tmp1[0].strip()
+                        self.tabblockdict[i] = read_array_table(cblock)
+                        continue
+                    elif control_format(tmp1[0].strip()) == 'csv':
+                        # the size is only known once the whole file is read
+                        cblock.extfile = tmp1[0].strip()
+                        self.tabblockdict[i] = read_csv_table(cblock,self.chunksize)
+                        continue
                     else:
+                        cblock.extfile = tmp1[0].strip()
+                        # only the header is read here, the rows are read over a memory map
                         try:
-                            cbdata = open(tmp1[0].strip(),'r').readlines()
-                        except:
+                            mf = open_table_file(cblock.extfile)
+                        except EnvironmentError:
                             raise(ExternalFileOpenError(tmp1[0],i))
+                        cbdata = mf.readlines(2)
+                        mf.close()
+                        # line numbers are reported relative to the external file
+                        hline = 1
             else:
                 #read between the boundaries of the block
                 cbdata = self.indat[cblock.blockstart+1:cblock.blockend]
+                hline = cblock.blockstart + 2
             #--if an XLS wasn't read
             if not isExcel:
-                # pull out the header information and parse nrow and ncol
-                cheader = cbdata.pop(0)
-                header_data = cheader.strip().split('=')
-                hd = []
-                for j in header_data:
-                    hd.extend(j.split())
-                # check that the header information is correctly formatted
-                if len(hd) == 0:
-                    raise(TableBlockEmpty(i,cblock.blockstart+2))
+                clabels = self.key_read_table_header(cblock,cbdata,hline)
+                if cblock.blocktype == 'file' and self.stream_files:
+                    # the rows are streamed on output
+                    cblock.streamed = True
+                    continue
+                if self.lazy:
+                    # the rows are parsed on first use of the columns; inline
+                    # rows can be counted now, external files are counted then
+                    if cblock.blocktype != 'file' and len(cbdata) != cblock.nrow:
+                        raise(TableBlockRowError(i,cblock.nrow,len(cbdata)))
+                    self.tabblockdict[i] = lazy_columns(self,cblock)
+                    continue
+                if self.cache is not None:
+                    cblock.cachekey = self.key_table_cache_key(cblock)
+                    cdict = self.key_table_cache_get(cblock)
+                    if cdict is not None:
+                        self.tabblockdict[i] = cdict
+                        continue
+                if cblock.blocktype == 'file' and self.nworkers > 1 and not compression_ext(cblock.extfile):
+                    # compressed files cannot be split into byte ranges
+                    pending.append((cblock,self.key_table_file_tasks(cblock)))
+                    continue
+
+                if self.nworkers > 1 and len(cbdata) > self.chunksize:
+                    # split large blocks into chunks for the worker pool
+                    ctasks = list()
+                    for j in xrange(0,len(cbdata),self.chunksize):
+                        ctasks.append((i,clabels,cblock.datastart+j,cbdata[j:j+self.chunksize]))
+                    pending.append((cblock,ctasks))
+                    continue
+
+                self.tabblockdict[i] = self.key_parse_table(cblock)
+
+        if len(pending) > 0:
+            self.key_read_table_pool(pending)
+
+    def key_parse_table(self,cblock):
+        '''parse the rows of a table block whose header has been read into typed
+        columns, checking the number of columns and rows
+        '''
+        i = cblock.blockname
+        if cblock.blocktype == 'file':
+            chunks = list(iter_table_file(cblock,self.chunksize))
+            if len(chunks) == 0:
+                # a file without rows still gets its empty typed columns
+                chunks.append(read_table_rows([],i,cblock.clabels,cblock.datastart))
+            cdict = concat_columns(chunks)
+            del chunks
+        else:
+            # the rows follow the header and column label lines
+            cbdata = self.indat[cblock.blockstart+3:cblock.blockend]
+            cdict = read_table_rows(cbdata,i,cblock.clabels,cblock.datastart)
+            if len(cbdata) != cblock.nrow:
+                raise(TableBlockRowError(i,cblock.nrow,len(cbdata)))
+        self.key_table_cache_put(cblock,cdict)
+        return cdict
+
+    def key_load_table(self,cblock):
+        '''the columns of a lazy table block, from the cache or parsed'''
+        if self.cache is not None:
+            cblock.cachekey = self.key_table_cache_key(cblock)
+            cdict = self.key_table_cache_get(cblock)
+            if cdict is not None:
+                return cdict
+        return self.key_parse_table(cblock)
+
+    # ############################################################ #
+    # cache keys for table blocks and storing of the parsed blocks #
+    # ############################################################ #
+    def key_table_cache_key(self,cblock):
+        '''inline tables are keyed by the block text, external files by their contents'''
+        ctext = ''.join(self.indat[cblock.blockstart+1:cblock.blockend])
+        if cblock.blocktype == 'file':
+            try:
+                mf = open_table_file(cblock.extfile)
+            except EnvironmentError:
+                raise(ExternalFileOpenError(cblock.extfile,cblock.blockname))
+            try:
+                chash = mf.sha1()
+            finally:
+                mf.close()
+            return self.cache.key('file',cblock.blockname,ctext,chash)
+        return self.cache.key('tab',cblock.blockname,ctext)
+
+    def key_table_cache_put(self,cblock,cdict):
+        if self.cache is not None and cblock.cachekey is not None:
+            # string columns are stored as fixed width arrays, which pickle
+            # and load much faster than arrays of python strings
+            cdict = dict(cdict)
+            for k,v in cdict.items():
+                if v.dtype == object:
+                    v = v.astype(str)
+                cdict[k] = v
+            self.cache.put(cblock.cachekey,cdict)
+
+    def key_table_cache_get(self,cblock):
+        cdict = self.cache.get(cblock.cachekey)
+        if cdict is not None:
+            for k,v in cdict.iteritems():
+                if v.dtype.kind == 'S':
+                    cdict[k] = v.astype(object)
+        return cdict
+
+    # ###################################################################### #
+    # split an external table file into byte ranges for the worker processes #
+    # ###################################################################### #
+    def key_table_file_tasks(self,cblock):
+        '''the lines in each range are counted here so that every chunk knows
+        the absolute line number of its first row
+        '''
+        try:
+            mf = mapped_file(cblock.extfile)
+        except EnvironmentError:
+            raise(ExternalFileOpenError(cblock.extfile,cblock.blockname))
+        ctasks = list()
+        cline = cblock.datastart
+        try:
+            mf.readlines(2)
+            for start,end in mf.spans(self.chunksize):
+                ctasks.append((cblock.blockname,cblock.clabels,cline,(cblock.extfile,start,end)))
+                text = mf.mm[start:end]
+                cline += text.count('\n')
+                if not text.endswith('\n'):
+                    cline += 1
+        finally:
+            mf.close()
+        return ctasks
+
+    # ############################################################ #
+    # parse chunks of table rows across a pool of worker processes #
+    # ############################################################ #
+    def key_read_table_pool(self,pending):
+        '''pending is a list of (cblock,tasks); chunks come back in order and
+        the first failing chunk raises the same error as the serial reader
+        '''
+        import multiprocessing
+        pool = multiprocessing.Pool(self.nworkers)
+        try:
+            results = pool.imap(read_table_task,[t for cblock,ctasks in pending for t in ctasks])
+            for cblock,ctasks in pending:
+                chunks = list()
+                for t in ctasks:
+                    isok,res = results.next()
+                    if not isok:
+                        raise_task_error(res)
+                    chunks.append(res)
+                nrow = sum([len(chunk[cblock.clabels[0]]) for chunk in chunks])
+                if len(chunks) == 0:
+                    # a block without rows still gets its empty typed columns
+                    chunks.append(read_table_rows([],cblock.blockname,cblock.clabels,
+                                                  cblock.datastart))
+                self.tabblockdict[cblock.blockname] = concat_columns(chunks)
+                if nrow != cblock.nrow:
+                    raise(TableBlockRowError(cblock.blockname,cblock.nrow,nrow))
+                self.key_table_cache_put(cblock,self.tabblockdict[cblock.blockname])
+        except:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+
+    # ################################################################# #
+    # parse and check the NROW/NCOL header and column labels of a table #
+    # ################################################################# #
+    def key_read_table_header(self,cblock,cbdata,hline):
+        '''pops the header and column label lines off cbdata and returns the labels
+        hline is the line number of the header, used for error reporting
+        '''
+        i = cblock.blockname
+        # pull out the header information and parse nrow and ncol
+        cheader = cbdata.pop(0)
+        header_data = cheader.strip().split('=')
+        hd = []
+        for j in header_data:
+            hd.extend(j.split())
+        # check that the header information is correctly formatted
+        if len(hd) == 0:
+            raise(TableBlockEmpty(i,hline))
+        try:
+            if ((hd[0].lower() == 'nrow') and
+                (hd[2].lower() == 'ncol') and
+                (hd[4].lower() == 'columnlabels')):
                 try:
-                    if ((hd[0].lower() == 'nrow') and
-                        (hd[2].lower() == 'ncol') and
-                        (hd[4].lower() == 'columnlabels')):
-                        try:
-                            cblock.nrow = int(hd[1])
-                        except:
-                            raise(TableBlockHeaderError(cblock.blockstart+2))
-                        try:
-                            cblock.ncol = int(hd[3])
-                        except:
-                            raise(TableBlockHeaderError(cblock.blockstart+2))
+                    cblock.nrow = int(hd[1])
                 except:
-                    raise(TableBlockHeaderError(cblock.blockstart+2))
+                    raise(TableBlockHeaderError(hline))
+                try:
+                    cblock.ncol = int(hd[3])
+                except:
+                    raise(TableBlockHeaderError(hline))
+        except:
+            raise(TableBlockHeaderError(hline))
 
+        # pull off the column labels and check them
+        clabels = cbdata.pop(0).strip().split()
+        if len(clabels) != cblock.ncol:
+            raise(TableBlockColError(i,hline+1,cblock.ncol,len(clabels)))
+        for keyy in clabels:
+            if keyy not in cblock.colnames:
+                raise(BlockIllegalColumn(i,keyy))
+        cblock.clabels = clabels
+        cblock.datastart = hline + 2
+        return clabels
 
-                # pull off the column labels
-                clabels = cbdata.pop(0).strip().split()
+    # ######################################################################### #
+    # Table block access that works for both in-memory and streamed FILE blocks #
+    # ######################################################################### #
+    def tab_chunks(self,name):
+        '''iterate over a table block as dictionaries of typed columns
+        streamed FILE blocks come chunksize rows at a time, others as one chunk
+        '''
+        cblock = self.tabblocks.get(name)
+        if cblock is not None and cblock.streamed:
+            for cdict in iter_table_file(cblock,self.chunksize):
+                yield cdict
+        else:
+            yield self.tabblockdict[name]
 
-                # check each row for the correct number of columns
-                cline = cblock.blockstart + 3
-                if len(clabels) != cblock.ncol:
-                    raise(TableBlockColError(i,cline,cblock.ncol,len(clabels)))
-                for line in cbdata:
-                    cline += 1
-                    if '#' in line:
-                        raise(TableCommentError(cline,cblock.blockname))
+    def tab_nrow(self,name,colname):
+        '''number of rows in column colname of a table block, from the NROW
+        header for streamed and unparsed lazy blocks so that they need not be read
+        '''
+        cblock = self.tabblocks.get(name)
+        cdict = self.tabblockdict[name]
+        if cblock is not None and (cblock.streamed or
+                                   (isinstance(cdict,lazy_columns) and not cdict.loaded)):
+            if colname not in cblock.clabels:
+                raise KeyError(colname)
+            return cblock.nrow
+        return len(cdict[colname])
+
+    def tab_rows(self):
+        '''number of rows of each table block read so far'''
+        rows = dict()
+        for name,cblock in self.tabblocks.iteritems():
+            cdict = self.tabblockdict.get(name,dict())
+            if cblock.streamed or (isinstance(cdict,lazy_columns) and not cdict.loaded):
+                rows[name] = cblock.nrow
+            elif len(cdict) > 0:
+                rows[name] = len(cdict.values()[0])
+        return rows
+
+    def tab_load_lazy(self):
+        '''parse the rows of every lazy table block not yet used'''
+        for cdict in self.tabblockdict.values():
+            if isinstance(cdict,lazy_columns):
+                cdict.load()
+
+    def tab_isempty(self,name):
+        cblock = self.tabblocks.get(name)
+        if cblock is not None and cblock.streamed:
+            return False
+        return len(self.tabblockdict[name]) == 0
+
+    def tab_names(self,name,colname):
+        '''set of the lower case names in a column of a table block'''
+        names = set()
+        if name in self.tabblockdict and not self.tab_isempty(name):
+            for cdict in self.tab_chunks(name):
+                if colname in cdict:
+                    names.update([v.lower() for v in cdict[colname]])
+        return names
+
+    def tab_load_streamed(self):
+        '''read any streamed FILE blocks fully into tabblockdict'''
+        for name,cblock in self.tabblocks.iteritems():
+            if cblock.streamed:
+                self.tabblockdict[name] = concat_columns(self.tab_chunks(name))
+                cblock.streamed = False
+
+    # ######################################### #
+    # Binary snapshots of a parsed file_control #
+    # ######################################### #
+    def save_snapshot(self,fname):
+        '''save the parsed blocks to an .npz archive: one array per table column
+        plus a header array holding the keyword blocks and table metadata
+        '''
+        import numpy as np
+        self.tab_load_streamed()
+        header = {'version' : SNAPSHOT_VERSION,
+                  'kwblocks' : dict(),
+                  'tabblocks' : dict(),
+                  'tabcols' : dict()}
+        for name,cblock in self.kwblocks.iteritems():
+            header['kwblocks'][name] = (cblock.kwdict,cblock.blockstart,cblock.blockend)
+        for name,cblock in self.tabblocks.iteritems():
+            header['tabblocks'][name] = (cblock.nrow,cblock.ncol,cblock.clabels,cblock.extfile,
+                                         cblock.blockstart,cblock.blockend,cblock.blocktype,
+                                         cblock.datastart)
+        arrays = dict()
+        for name,cdict in self.tabblockdict.iteritems():
+            header['tabcols'][name] = cdict.keys()
+            for colname,cvals in cdict.iteritems():
+                # strings are stored as fixed width so that no pickling is needed
+                if cvals.dtype == object:
+                    cvals = cvals.astype(str)
+                arrays[name+'.'+colname] = cvals
+        arrays['header'] = np.array(repr(header))
+        ofp = open(fname,'wb')
+        try:
+            np.savez(ofp,**arrays)
+        finally:
+            ofp.close()
+
+    def load_snapshot(self,fname):
+        '''replace the blocks of this file_control with those saved by save_snapshot'''
+        import numpy as np
+        snap = np.load(fname,allow_pickle=False)
+        try:
+            try:
+                header = ast.literal_eval(str(snap['header']))
+            except (KeyError,ValueError,SyntaxError):
+                raise(SnapshotVersionError(fname,None))
+            if not isinstance(header,dict):
+                raise(SnapshotVersionError(fname,None))
+            if header.get('version') != SNAPSHOT_VERSION:
+                raise(SnapshotVersionError(fname,header.get('version')))
+            self.kwblocks = dict()
+            for name,(kwdict,blockstart,blockend) in header['kwblocks'].iteritems():
+                self.kwblocks[name] = kw(name,kwdict,blockstart=blockstart,blockend=blockend)
+            self.tabblocks = dict()
+            for name,meta in header['tabblocks'].iteritems():
+                nrow,ncol,clabels,extfile,blockstart,blockend,blocktype,datastart = meta
+                cblock = tb(name,tabblocks[name],nrow=nrow,ncol=ncol,blockstart=blockstart,
+                            blockend=blockend,blocktype=blocktype)
+                cblock.clabels = clabels
+                cblock.extfile = extfile
+                cblock.datastart = datastart
+                self.tabblocks[name] = cblock
+            self.tabblockdict = new_tabblockdicts()
+            for name,colnames in header['tabcols'].iteritems():
+                cdict = dict()
+                for colname in colnames:
+                    cvals = snap[name+'.'+colname]
+                    if cvals.dtype.kind == 'S':
+                        cvals = cvals.astype(object)
+                    cdict[colname] = cvals
+                self.tabblockdict[name] = cdict
+        finally:
+            snap.close()
+
+    # ########################################### #
+    # check that names in table blocks are unique #
+    # ########################################### #
+    def check_unique_names(self):
+        '''PEST names must be unique, case insensitively, within their block
+        the names are checked a chunk at a time against one set of lower case
+        names, so memory grows with the number of names but no copy of a streamed
+        column is made; the rows of any duplicates are found by a second pass
+        '''
+        dupes = list()
+        for name,colname in tabunique:
+            if name not in self.tabblockdict or self.tab_isempty(name):
+                continue
+            seen = set()
+            dupkeys = set()
+            for cdict in self.tab_chunks(name):
+                if colname not in cdict:
+                    break
+                keys = [cval.lower() for cval in cdict[colname]]
+                ckeys = set(keys)
+                # most chunks hold no duplicates at all
+                if len(ckeys) == len(keys) and seen.isdisjoint(ckeys):
+                    seen.update(ckeys)
+                    continue
+                for k in keys:
+                    if k in seen:
+                        dupkeys.add(k)
                     else:
-                        tmp = line.strip().split()
-                        if i != 'prior_information':
-                            if len(tmp) != cblock.ncol:
-                                raise(TableBlockColError(i,cline,cblock.ncol,len(tmp)))
-                        elif len(tmp) < 1: 
-                            raise(TableBlockColError(i,cline,cblock.ncol,len(tmp)))
-                # now check the number of rows
-                if len(cbdata) != cblock.nrow:
-                    raise(TableBlockRowError(i,cblock.nrow,len(cbdata)))   
-
-                # parse the data into a dictionary for later output
-                data_array = list()
-                for line in cbdata:
-                    if '#' not in line:
-                        if i != 'prior_information':
-                            data_array.append(line.strip().split())
+                        seen.add(k)
+            del seen
+            if len(dupkeys) == 0:
+                continue
+            where = dict()
+            crow = 0
+            for cdict in self.tab_chunks(name):
+                cvals = cdict[colname]
+                for j,cval in enumerate(cvals):
+                    k = cval.lower()
+                    if k in dupkeys:
+                        where.setdefault(k,[cval]).append(crow+j)
+                crow += len(cvals)
+            cblock = self.tabblocks.get(name)
+            # where holds the first spelling of each name, then its rows
+            for found in sorted(where.values(),key=lambda v: v[1]):
+                cval,idx = found[0],found[1:]
+                if cblock is not None:
+                    wheres = [cblock.row_location(j) for j in idx]
+                else:
+                    wheres = ['entry ' + str(j+1) for j in idx]
+                dupes.append((name,colname,cval,wheres))
+        if len(dupes) > 0:
+            raise(TableDuplicateError(dupes))
+
+    # ######################################################### #
+    # check that names used in table blocks are defined as well #
+    # ######################################################### #
+    def check_references(self):
+        '''each defining column is indexed once as a set of lower case names
+        (PEST names are case insensitive), then every reference is looked up;
+        all dangling references are reported together. The references are
+        streamed a chunk at a time, but the sets need memory in proportion to
+        the number of defined names
+        '''
+        indexes = dict()
+        dangling = list()
+        for name,colname,target,tcolname in tabrefs:
+            if name not in self.tabblockdict or self.tab_isempty(name):
+                continue
+            if (target,tcolname) not in indexes:
+                indexes[(target,tcolname)] = self.tab_names(target,tcolname)
+            cindex = indexes[(target,tcolname)]
+            cblock = self.tabblocks.get(name)
+            crow = 0
+            for cdict in self.tab_chunks(name):
+                if colname not in cdict:
+                    break
+                cvals = cdict[colname]
+                exempt = tabrefs_exempt.get((name,colname))
+                if exempt is not None and exempt[1] in cdict:
+                    evals = cdict[exempt[1]]
+                else:
+                    exempt = None
+                for j,cval in enumerate(cvals):
+                    if cval.lower() not in cindex:
+                        if (exempt is not None and cval.lower() == exempt[0] and
+                                evals[j].lower() in exempt[2]):
+                            continue
+                        if cblock is not None:
+                            where = cblock.row_location(crow+j)
                         else:
-                            data_array.append(line.strip())
-                data_array = np.atleast_2d(np.squeeze(np.array(data_array)))
-                for jj,keyy in enumerate(clabels):
-                    if keyy in legal_columns:
-                        if cblock.ncol == 1:
-                            self.tabblockdict[i][keyy] = data_array[0]
+                            where = 'entry ' + str(crow+j+1)
+                        dangling.append((name,colname,cval,target,tcolname,where))
+                crow += len(cvals)
+        if len(dangling) > 0:
+            raise(TableReferenceError(dangling))
+
+    # ##################################################### #
+    # check the values of parameter and observation columns #
+    # ##################################################### #
+    def check_values(self):
+        '''vectorized range checks on parameter_data and observation_data
+        returns a list of (block,check,rows) for the failed checks, rows being
+        an array of the offending row indices (from 0)
+        '''
+        import numpy as np
+        report = list()
+        for name in ('parameter_data','observation_data'):
+            if name not in self.tabblockdict or self.tab_isempty(name):
+                continue
+            found = dict()
+            order = list()
+            crow = 0
+            for cdict in self.tab_chunks(name):
+                # NaN never fails a comparison, only the OBSVAL check
+                with np.errstate(invalid='ignore'):
+                    checks = value_checks(name,cdict)
+                for ccheck,mask in checks:
+                    if ccheck not in found:
+                        found[ccheck] = list()
+                        order.append(ccheck)
+                    found[ccheck].append(np.flatnonzero(mask) + crow)
+                if len(cdict) > 0:
+                    crow += len(cdict.values()[0])
+            for ccheck in order:
+                rows = np.concatenate(found[ccheck])
+                if len(rows) > 0:
+                    report.append((name,ccheck,rows))
+        return report
+
+    def key_check_values(self):
+        report = self.check_values()
+        if len(report) > 0:
+            raise(TableValueError(report,self.tabblocks))
+
+    # ################################################## #
+    # Read a PST file section by section into the blocks #
+    # ################################################## #
+    def pst_read(self,fname):
+        '''read a PST control file (a name or a file-like object) one section at
+        a time: keyword sections follow the line layout of pst_write, table
+        sections are parsed in bulk and observation data chunksize rows at a time
+        '''
+        if isinstance(fname,basestring):
+            fp = open_compressed(fname,'r')
+        else:
+            fp = fname
+        defaults = self.read_defaults()
+        section = None      # header line of the current section
+        lines = list()      # lines of the current section not parsed yet
+        sline = 2           # line number of lines[0]
+        chunks = list()     # observation data parsed so far
+        nline = 0           # lines read so far
+        try:
+            for batch in iter(lambda: fp.readlines(PST_BATCH),[]):
+                text = '\n' + ''.join(batch)
+                if section is not None and '\n*' not in text and '\n++' not in text:
+                    # no section starts in this batch
+                    lines.extend(batch)
+                else:
+                    for cline,line in enumerate(batch,nline+1):
+                        if line.startswith('*'):
+                            self.pst_read_section(section,lines,sline,chunks,defaults)
+                            section = ' '.join(line.split()).lower()
+                            lines = list()
+                            sline = cline + 1
+                            chunks = list()
+                        elif line.startswith('++'):
+                            self.pst_read_pestpp(line,cline,defaults)
+                        elif section is None:
+                            if cline > 1 or line.split()[:1] != ['pcf']:
+                                raise(PstLineError('pcf',cline,'PST files must start with a "pcf" line'))
                         else:
-                            self.tabblockdict[i][keyy] = data_array[:,jj]
-                    else:
-                        raise(BlockIllegalColumn(i,keyy))
+                            lines.append(line)
+                del text
+                nline += len(batch)
+                # parse the largest section as it streams past
+                while section == '* observation data' and len(lines) >= self.chunksize:
+                    chunks.append(read_table_rows(lines[:self.chunksize],'observation_data',
+                                                  tabblocks['observation_data'],sline))
+                    sline += self.chunksize
+                    del lines[:self.chunksize]
+            self.pst_read_section(section,lines,sline,chunks,defaults)
+        finally:
+            if fp is not fname:
+                fp.close()
+        if 'control_data' not in self.kwblocks:
+            raise(MissingBlockError('control_data'))
+
+    def pst_read_section(self,section,lines,sline,chunks,defaults):
+        '''parse the lines of one section; chunks holds the observation data
+        parsed while the section was read
+        '''
+        if section is None:
+            return
+        # blank lines may trail a section
+        while len(lines) > 0 and len(lines[-1].split()) == 0:
+            lines.pop()
+        name = '_'.join(section.split()[1:])
+        if name in self.kwblocks or name in self.tabblocks or (
+            name == 'model_input/output' and 'model_input' in self.tabblocks):
+            raise(PstLineError(name,sline-1,'duplicate section'))
+        if name in self.kwblocksall:
+            self.pst_read_kwsection(name,lines,sline,defaults)
+        elif name == 'parameter_groups':
+            # the optional columns are written in order, as far as they are set
+            clabels = tabblocks[name][:len(lines[0].split())] if len(lines) > 0 else []
+            self.pst_add_table(name,clabels,[read_table_rows(lines,name,clabels,sline)],sline)
+        elif name == 'parameter_data':
+            # NPAR parameter lines are followed by one line per tied parameter
+            npar = self.pst_count('NPAR')
+            clabels = tabblocks[name]
+            self.pst_add_table(name,clabels,[read_table_rows(lines[:npar],name,clabels,sline)],
+                               sline)
+            clabels = tabblocks['parameter_tied_data']
+            self.pst_add_table('parameter_tied_data',clabels,
+                               [read_table_rows(lines[npar:],'parameter_tied_data',clabels,sline+npar)],
+                               sline+npar)
+        elif name == 'observation_groups':
+            clabels = ['OBGNME']
+            if len(lines) > 0:
+                tmp = lines[0].split()
+                if len(tmp) == 3:
+                    clabels = tabblocks[name]
+                elif len(tmp) == 2:
+                    # either GTARG or COVFLE may be given alone
+                    clabels = ['OBGNME','COVFLE']
+                    if pst_token_fits(tmp[1],'real'):
+                        clabels = ['OBGNME','GTARG']
+            self.pst_add_table(name,clabels,[read_table_rows(lines,name,clabels,sline)],sline)
+        elif name == 'observation_data':
+            clabels = tabblocks[name]
+            # sline has moved past the rows parsed already
+            datastart = sline - sum([pst_chunk_nrow(c) for c in chunks])
+            chunks.append(read_table_rows(lines,name,clabels,sline))
+            self.pst_add_table(name,clabels,chunks,datastart)
+        elif name == 'model_command_line':
+            # command lines are kept whole
+            self.pst_add_lines(name,'COMLINE',[line.strip() for line in lines],sline)
+        elif name == 'model_input/output':
+            # NTPLFLE template lines are followed by NINSFLE instruction lines
+            ntpl = self.pst_count('NTPLFLE')
+            nins = self.pst_count('NINSFLE')
+            for cname,clines,cline in (('model_input',lines[:ntpl],sline),
+                                       ('model_output',lines[ntpl:ntpl+nins],sline+ntpl)):
+                clabels = tabblocks[cname]
+                self.pst_add_table(cname,clabels,[read_table_rows(clines,cname,clabels,cline)],
+                                   cline)
+            # pst_write gives predictive analysis without a section header
+            self.pst_read_kwsection('predictive_analysis',lines[ntpl+nins:],sline+ntpl+nins,defaults)
+        elif name == 'prior_information':
+            # join continuation lines, which start with '&'
+            nprior = self.pst_count('NPRIOR')
+            pilines = list()
+            for j,line in enumerate(lines):
+                if line.lstrip().startswith('&') and len(pilines) > 0:
+                    pilines[-1] = pilines[-1] + ' ' + line.strip()[1:].strip()
+                else:
+                    pilines.append(line.strip())
+                    if len(pilines) > nprior:
+                        # pst_write gives predictive analysis without a section header
+                        pilines.pop()
+                        self.pst_read_kwsection('predictive_analysis',lines[j:],sline+j,defaults)
+                        break
+            self.pst_add_lines(name,'PILINES',pilines,sline)
+        else:
+            raise(PstLineError(name,sline-1,'unknown section'))
+
+    def pst_read_kwsection(self,name,lines,sline,defaults):
+        '''fill keyword block name from the lines of its section'''
+        entries = [(sline+j,line.split()) for j,line in enumerate(lines) if len(line.split()) > 0]
+        if len(entries) == 0 and name == 'predictive_analysis':
+            return
+        self.kwblocks[name] = kw(name,dict(kwblocks[name]),blockstart=sline-1,blockend=sline+len(lines))
+        self.apply_defaults(self.kwblocks[name],defaults)
+        cdict = self.kwblocks[name].kwdict
+        layout = list(pstkwlines[name])
+        if name == 'regularisation' and len(entries) == len(layout) - 1:
+            # pst_write leaves out the PHIMLIM line
+            layout.pop(0)
+        j = 0
+        while j < len(layout):
+            if j >= len(entries):
+                raise(PstLineError(name,sline+len(lines),'%d lines expected, %d found' % (len(layout),len(entries))))
+            cline,tokens = entries[j]
+            mandatoryvals,optionalvals,optionaltypes = layout[j]
+            if len(tokens) < len(mandatoryvals):
+                raise(PstLineError(name,cline,'%d values expected, %d found' % (len(mandatoryvals),len(tokens))))
+            for cpar,cval in izip(mandatoryvals,tokens):
+                cdict[cpar] = cval
+            # optional values are matched in order, skipping those of the wrong type
+            k = 0
+            for cval in tokens[len(mandatoryvals):]:
+                while k < len(optionalvals) and not pst_token_fits(cval,optionaltypes[k]):
+                    k += 1
+                if k == len(optionalvals):
+                    print 'Warning: value %s on line %d of section "%s" not recognized: ignored' % (cval,cline,name)
+                    continue
+                cdict[optionalvals[k]] = cval
+                k += 1
+            # the pareto section has lines that depend on earlier values
+            if name == 'pareto':
+                if mandatoryvals == ['ALT_TERM']:
+                    if pst_int(cdict,'ALT_TERM') != 0:
+                        layout.append((['OBS_TERM','ABOVE_OR_BELOW','OBS_THRESH','NUM_ITER_THRESH'],[],[]))
+                    layout.append((['NOBS_REPORT'],[],[]))
+                elif mandatoryvals == ['NOBS_REPORT']:
+                    nrep = pst_int(cdict,'NOBS_REPORT')
+                    if nrep > 0:
+                        layout.append((['OBS_REPORT_%d' % (crep+1) for crep in xrange(nrep)],[],[]))
+            j += 1
+        if j < len(entries):
+            raise(PstLineError(name,entries[j][0],'%d lines expected, %d found' % (len(layout),len(entries))))
+
+    def pst_read_pestpp(self,line,cline,defaults):
+        '''fill the pest++ block from a ++ line of KEY(value) pairs'''
+        text = line[2:].strip()
+        if len(text) == 0 or text.startswith('#'):
+            return
+        if 'pest++' not in self.kwblocks:
+            self.kwblocks['pest++'] = kw('pest++',dict(kwblocks['pest++']),blockstart=cline)
+            self.apply_defaults(self.kwblocks['pest++'],defaults)
+        cdict = self.kwblocks['pest++'].kwdict
+        pairs = re.findall(r'([^\s()]+)\s*\(([^)]*)\)',text)
+        if len(pairs) == 0:
+            raise(PstLineError('pest++',cline,'KEY(value) pairs expected'))
+        for ckey,cval in pairs:
+            ckey = ckey.upper()
+            cval = cval.strip()
+            if ckey == 'GMAN_SOCKET':
+                # pst_write builds the socket from HOST and PORT
+                if ':' in cval:
+                    cdict['HOST'],cdict['PORT'] = cval.rsplit(':',1)
+                else:
+                    cdict['HOST'] = cval
+            if ckey in cdict:
+                cdict[ckey] = cval
+            else:
+                print 'Warning: PEST++ variable %s on line %d not recognized: ignored' % (ckey,cline)
+
+    def pst_count(self,cpar):
+        '''a count from the control data section, which comes first in a PST file'''
+        try:
+            return pst_int(self.kwblocks['control_data'].kwdict,cpar)
+        except KeyError:
+            raise(MissingBlockError('control_data'))
+
+    def pst_add_table(self,name,clabels,chunks,datastart):
+        '''create table block name from chunks of typed columns'''
+        nrow = sum([pst_chunk_nrow(c) for c in chunks])
+        if nrow == 0:
+            return
+        cblock = tb(name,tabblocks[name],nrow=nrow,ncol=len(clabels),blockstart=datastart-1)
+        cblock.clabels = clabels
+        cblock.datastart = datastart
+        self.tabblocks[name] = cblock
+        if len(chunks) == 1:
+            self.tabblockdict[name] = chunks[0]
+        else:
+            self.tabblockdict[name] = concat_columns(chunks)
+
+    def pst_add_lines(self,name,colname,clines,datastart):
+        '''create a single column table block of whole lines'''
+        import numpy as np
+        if len(clines) == 0:
+            return
+        cblock = tb(name,tabblocks[name],nrow=len(clines),ncol=1,blockstart=datastart-1)
+        cblock.clabels = [colname]
+        cblock.datastart = datastart
+        self.tabblocks[name] = cblock
+        self.tabblockdict[name] = {colname : np.array(clines,dtype=object)}
+
     # ###################### #
     # Write out the PST file #
     # ###################### #
     def pst_write(self,outfile):
-        # open an output file
-        ofp = open(outfile,'w')
+        # a named file is written through write_output, which opens it
+        if not hasattr(outfile,'write'):
+            return write_output(self.pst_write,outfile)
+        ofp = outfile
         # ###
         # Write out mandatory control data block
         # ###
@@ -1017,17 +3162,25 @@ class file_control():
         mandatorytypes = ['int','real','int','int','real','int']
         write_KW_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes,writenewline=False)
         # strange special case here
-        if cdict['PHISTOPTHRESH'] != UNINIT_REAL:
-            write_val(ofp,cdict['PHISTOPTHRESH'],'real','PHISTOPTHRESH',cblock) 
-        if cdict['LASTRUN'] != UNINIT_INT:
-            write_val(ofp,cdict['LASTRUN'],'int','LASTRUN',cblock)  
-        if cdict['PHIABANDON'] != UNINIT_INT:
-            if cdict['PHIABANDON'] != UNINIT_STRING:
-                try:
-                    int(cdict['PHIABANDON'])
-                    write_val(ofp,cdict['PHIABANDON'],'int','PHIABANDON',cblock)
-                except:
-                    write_val(ofp,cdict['PHIABANDON'],'string','PHIABANDON',cblock)
+        # the trailing values are positional, so a later value needs the
+        # earlier ones written too (PHISTOPTHRESH = 0.0 is the PEST default)
+        abandon = cdict['PHIABANDON'] not in (UNINIT_INT,UNINIT_STRING)
+        lastrun = cdict['LASTRUN']
+        if lastrun == UNINIT_INT and abandon:
+            lastrun = 1
+        phistop = cdict['PHISTOPTHRESH']
+        if phistop == UNINIT_REAL and lastrun != UNINIT_INT:
+            phistop = 0.0
+        if phistop != UNINIT_REAL:
+            write_val(ofp,phistop,'real','PHISTOPTHRESH',cblock) 
+        if lastrun != UNINIT_INT:
+            write_val(ofp,lastrun,'int','LASTRUN',cblock)  
+        if abandon:
+            try:
+                int(cdict['PHIABANDON'])
+                write_val(ofp,cdict['PHIABANDON'],'int','PHIABANDON',cblock)
+            except:
+                write_val(ofp,cdict['PHIABANDON'],'string','PHIABANDON',cblock)
         ofp.write('\n')
         # write a line
         mandatoryvals = ['ICOV', 'ICOR', 'IEIG']
@@ -1146,8 +3299,7 @@ class file_control():
         # Write out mandatory parameter groups block
         # ###        
         cblock = 'parameter_groups'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             raise(MissingBlockError(cblock))
         else:
             ofp.write('* parameter groups\n')
@@ -1156,38 +3308,38 @@ class file_control():
             mandatorytypes = ['string','string','real','real','string','real','string']
             optionalvals = ['SPLITTHRESH', 'SPLITRELDIFF', 'SPLITACTION']
             optionaltypes = ['real','real','string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes,optionalvals,optionaltypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes,optionalvals,optionaltypes)
             
         # ###
         # Write out mandatory parameter data block
         # ###        
         cblock = 'parameter_data'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             raise(MissingBlockError(cblock))
         else:
             ofp.write('* parameter data\n')
             mandatoryvals = ['PARNME', 'PARTRANS', 'PARCHGLIM', 'PARVAL1', 'PARLBND', 'PARUBND', 'PARGP', 'SCALE', 'OFFSET', 'DERCOM']
             mandatorytypes = ['string','string','string','real','real','real','string','real','real','int','string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
 
         # ###
         # Write out optional parameter tied data block
         # ###        
         cblock = 'parameter_tied_data'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             pass
         else:
             mandatoryvals = ['PARNME', 'PARTIED']
             mandatorytypes = ['string','string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
         # ###
         # Write out mandatory observation groups block
         # ###        
         cblock = 'observation_groups'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             raise(MissingBlockError(cblock))
         else:
             ofp.write('* observation groups\n')
@@ -1195,20 +3347,21 @@ class file_control():
             mandatorytypes = ['string']
             optionalvals = ['GTARG', 'COVFLE']
             optionaltypes = ['real','string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes,optionalvals,optionaltypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes,optionalvals,optionaltypes)
 
         # ###
         # Write out mandatory observation data block
         # ###        
         cblock = 'observation_data'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             raise(MissingBlockError(cblock))
         else:
             ofp.write('* observation data\n')
             mandatoryvals = ['OBSNME', 'OBSVAL', 'WEIGHT', 'OBGNME']
             mandatorytypes = ['string','real','real','string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
             
         # ###
         # Write out optional derivatives command line block
@@ -1228,48 +3381,48 @@ class file_control():
         # Write out mandatory model command line block
         # ###        
         cblock = 'model_command_line'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             raise(MissingBlockError(cblock))
         else:
             ofp.write('* model command line\n')
             mandatoryvals = ['COMLINE']
             mandatorytypes = ['string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
             
         # ###
         # Write out mandatory model input/output block
         # ###        
         ofp.write('* model input/output\n')
         cblock = 'model_input'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             raise(MissingBlockError(cblock))
         else:
             mandatoryvals = ['TEMPFLE', 'INFLE']
             mandatorytypes = ['string','string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
         cblock = 'model_output'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             raise(MissingBlockError(cblock))
         else:
             mandatoryvals = ['INSFLE', 'OUTFLE']
             mandatorytypes = ['string','string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)        
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)        
 
         # ###
         # Write out optional prior information block
         # ###        
         cblock = 'prior_information'
-        cdict = self.tabblockdict[cblock]
-        if len(cdict) == 0:
+        if self.tab_isempty(cblock):
             pass
         else:
             ofp.write('* prior information\n')
             mandatoryvals = ['PILINES']
             mandatorytypes = ['string']
-            write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
+            for cdict in self.tab_chunks(cblock):
+                write_TAB_line(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
         
         # ###
         # Write out optional predictive analysis block
@@ -1427,11 +3580,6 @@ class file_control():
             ofp.write('++ ')
             write_KW_line_ppp(ofp,cdict,cblock,mandatoryvals,mandatorytypes)
                  
-        # ######
-        # CLOSE THE PST FILE
-        # ######
-        ofp.close()
-        
 # ###################################################### #
 # DICTIONARY OF KEWYWORD BLOCK NAMES, PARS, AND DEFAULTS #
 # ###################################################### #
@@ -1640,6 +3788,62 @@ jup2pst = {'control_data':'* control data',
            'pest++':'pest++',
            'parameter_tied_data':'!JUNK!'}
 
+# ########################################################################### #
+# LINE LAYOUT OF THE KEYWORD SECTIONS OF A PST FILE (AS WRITTEN BY PST_WRITE) #
+# ########################################################################### #
+# one (mandatory keywords, optional keywords, optional types) entry per line;
+# the lines of the pareto section that depend on ALT_TERM and NOBS_REPORT are added by pst_read_kwsection
+pstkwlines = {'control_data' : # ######################
+              [(['RSTFLE', 'PESTMODE'],[],[]),
+               (['NPAR', 'NOBS', 'NPARGP', 'NPRIOR', 'NOBSGP'],['MAXCOMPDIM'],['int']),
+               (['NTPLFLE', 'NINSFLE', 'PRECIS', 'DPOINT'],['NUMCOM', 'JACFILE', 'MESSFILE'],['int','int','int']),
+               (['RLAMBDA1', 'RLAMFAC', 'PHIRATSUF', 'PHIREDLAM', 'NUMLAM'],
+                ['JACUPDATE', 'LAMFORGIVE', 'MESSFILE'],['int','string','int']),
+               (['RELPARMAX', 'FACPARMAX', 'FACORIG'],['IBOUNDSTICK', 'UPVECBEND'],['int','int']),
+               (['PHIREDSWH'],['NOPTSWITCH', 'SPLITSWH','DOAUI','DOSENREUSE'],['int','real','string','string']),
+               (['NOPTMAX', 'PHIREDSTP', 'NPHISTP', 'NPHINORED', 'RELPARSTP', 'NRELPAR'],
+                ['PHISTOPTHRESH', 'LASTRUN', 'PHIABANDON'],['real','int','string']),
+               (['ICOV', 'ICOR', 'IEIG'],['IRES','JCOSAVE', 'VERBOSEREC','JCOSAVEITN', 'REISAVEITN','PARSAVEITN'],
+                ['int','string','string','string','string','string'])],
+              'automatic_user_intervention' : # ######################
+              [(['MAXAUI', 'AUISTARTOPT', 'NOAUIPHIRAT', 'AUIRESTITN'],[],[]),
+               (['AUISENSRAT', 'AUIHOLDMAXCHG', 'AUINUMFREE'],[],[]),
+               (['AUIPHIRATSUF', 'AUIPHIRATACCEPT', 'NAUINOACCEPT'],[],[])],
+              'singular_value_decomposition' : # ######################
+              [(['SVDMODE'],[],[]),
+               (['MAXSING', 'EIGTHRESH'],[],[]),
+               (['EIGWRITE'],[],[])],
+              'lsqr' : # ######################
+              [(['LSQRMODE'],[],[]),
+               (['LSQR_ATOL', 'LSQR_BTOL', 'LSQR_CONLIM', 'LSQR_ITNLIM'],[],[]),
+               (['LSQRWRITE'],[],[])],
+              'svd_assist' : # ######################
+              [(['BASEPESTFILE'],[],[]),
+               (['BASEJACFILE'],[],[]),
+               (['SVDA_MULBPA', 'SVDA_SCALADJ', 'SVDA_EXTSUPER', 'SVDA_SUPDERCALC'],['SVDA_PAR_EXCL'],['int'])],
+              'sensitivity_reuse' : # ######################
+              [(['SENRELTHRESH', 'SENMAXREUSE'],[],[]),
+               (['SENALLCALCINT', 'SENPREDWEIGHT', 'SENPIEXCLUDE'],[],[])],
+              'derivatives_command_line' : # ######################
+              [(['DERCOMLINE'],[],[]),
+               (['EXTDERFLE'],[],[])],
+              'predictive_analysis' : # ######################
+              [(['NPREDMAXMIN'],['PREDNOISE'],['int']),
+               (['PD0', 'PD1', 'PD2'],[],[]),
+               (['ABSPREDLAM', 'RELPREDLAM', 'INITSCHFAC', 'MULSCHFAC', 'NSEARCH'],[],[]),
+               (['ABSPREDSWH', 'RELPREDSWH'],[],[]),
+               (['NPREDNORED', 'ABSPREDSTP', 'RELPREDSTP', 'NPREDSTP'],[],[])],
+              'regularisation' : # ######################
+              [(['PHIMLIM', 'PHIMACCEPT'],['FRACPHIM', 'MEMSAVE'],['real','string']),
+               (['WFINIT', 'WFMIN', 'WFMAX'],['LINREG', 'REGCONTINUE'],['string','string']),
+               (['WFFAC', 'WFTOL', 'IREGADJ'],['NOPTREGADJ', 'REGWEIGHTRAT', 'REGSINGTHRESH'],['int','real','real'])],
+              'pareto' : # ######################
+              [(['PARETO_OBSGROUP'],[],[]),
+               (['PARETO_WTFAC_START', 'PARETO_WTFAC_FIN', 'NUM_WTFAC_INC'],[],[]),
+               (['NUM_ITER_START', 'NUM_ITER_GEN', 'NUM_ITER_FIN'],[],[]),
+               (['ALT_TERM'],[],[])]}
+pstkwlines['regularization'] = pstkwlines['regularisation']
+
 table2tag = {'parameter_groups':'PARGPNME',
              'parameter_data':'PARNME',
              'observation_groups':'OBGNME',
@@ -1675,24 +3879,69 @@ tabblocks = {'parameter_groups' : # ######################
              ['INSFLE', 'OUTFLE'],
              'prior_information' : # ######################
              ['PILINES']}
-tabblockdicts = {'parameter_groups' : # ######################
-                 dict(),
-                 'parameter_data' : # ######################
-                 dict(),
-                 'parameter_tied_data' : # ######################
-                 dict(),
-                 'observation_groups' : # ######################
-                 dict(),
-                 'observation_data' : # ######################
-                 dict(),
-                 'model_command_line' : # ######################
-                 dict(),
-                 'model_input' : # ######################
-                 dict(),
-                 'model_output' : # ######################
-                 dict(),
-                 'prior_information' : # ######################
-                 dict()}
+# ###################################################################### #
+# DICTIONARY OF NON-STRING TABLE COLUMN TYPES (AS DECLARED IN PST_WRITE) #
+# ###################################################################### #
+tabcoltypes = {'parameter_groups' : # ######################
+               {'DERINC' : 'real',
+                'DERINCLB' : 'real',
+                'DERINCMUL' : 'real',
+                'SPLITTHRESH' : 'real',
+                'SPLITRELDIFF' : 'real'},
+               'parameter_data' : # ######################
+               {'PARVAL1' : 'real',
+                'PARLBND' : 'real',
+                'PARUBND' : 'real',
+                'SCALE' : 'real',
+                'OFFSET' : 'real',
+                'DERCOM' : 'int'},
+               'observation_groups' : # ######################
+               {'GTARG' : 'real'},
+               'observation_data' : # ######################
+               {'OBSVAL' : 'real',
+                'WEIGHT' : 'real'}}
+# ################################################################ #
+# TABLE COLUMNS WHOSE NAMES MUST BE DEFINED IN ANOTHER TABLE BLOCK #
+# ################################################################ #
+# (block, column, defining block, defining column)
+tabrefs = [('parameter_data','PARGP','parameter_groups','PARGPNME'),
+           ('observation_data','OBGNME','observation_groups','OBGNME'),
+           ('parameter_tied_data','PARNME','parameter_data','PARNME'),
+           ('parameter_tied_data','PARTIED','parameter_data','PARNME')]
+# names that need no definition, allowed only where another column of the
+# same row takes one of the listed values
+# (block, column) : (name, other column, values)
+tabrefs_exempt = {('parameter_data','PARGP') : ('none','PARTRANS',('fixed','tied'))}
+# ####################################################### #
+# TABLE COLUMNS WHOSE NAMES MUST BE UNIQUE WITHIN A BLOCK #
+# ####################################################### #
+tabunique = [('parameter_groups','PARGPNME'),
+             ('parameter_data','PARNME'),
+             ('observation_groups','OBGNME'),
+             ('observation_data','OBSNME')]
+# ############################################################### #
+# EMPTY COLUMN DICTIONARIES OF THE TABLE BLOCKS, PER FILE_CONTROL #
+# ############################################################### #
+def new_tabblockdicts():
+    # a fresh set for every file_control so that no data is shared between them
+    return {'parameter_groups' : # ######################
+            dict(),
+            'parameter_data' : # ######################
+            dict(),
+            'parameter_tied_data' : # ######################
+            dict(),
+            'observation_groups' : # ######################
+            dict(),
+            'observation_data' : # ######################
+            dict(),
+            'model_command_line' : # ######################
+            dict(),
+            'model_input' : # ######################
+            dict(),
+            'model_output' : # ######################
+            dict(),
+            'prior_information' : # ######################
+            dict()}
 # ############# #
 # Error classes # 
 # ############# #
@@ -1713,19 +3962,19 @@ class BlockNameError(Exception):
 # -- duplicate block names used
 class BlockDuplicate(Exception):
     def __init__(self,dupes):
+        # list of (block name,lines of the BEGIN or END statements)
         self.dupes = dupes
     def __str__(self):
-        print "\n\nBlockDuplicate ERROR: The following block names are used more than once:"
-        for i in self.dupes:
-            print i
-        return
+        dupestr = ''
+        for i,clines in self.dupes:
+            dupestr += '\n' + i + ' on lines ' + ', '.join([str(cl+1) for cl in clines])
+        return("\n\nBlockDuplicate ERROR: The following block names are used more than once:" + dupestr)
 # -- mismatched begin and end 1
 class BlockMismatchNoEND(Exception):
     def __init__(self,blname):
         self.blname = blname
     def __str__(self):
-        print '\n\nBlockMismatch ERROR: Block "' + self.blname + '" BEGINS without END'
-        return
+        return('\n\nBlockMismatch ERROR: Block "' + self.blname + '" BEGINS without END')
 # -- mismatched begin and end 1
 class BlockReversed(Exception):
     def __init__(self,blname):
@@ -1737,8 +3986,7 @@ class BlockMismatchNoBEGIN(Exception):
     def __init__(self,blname):
         self.blname = blname
     def __str__(self):
-        print '\n\nBlockMismatch ERROR: Block "' + self.blname + '" ENDS without BEGIN'
-        return
+        return('\n\nBlockMismatch ERROR: Block "' + self.blname + '" ENDS without BEGIN')
 # -- nested blocks
 class BlockIllegalNesting(Exception):
     def __init__(self,blockin,blockout):
@@ -1759,9 +4007,8 @@ class TableBlockHeaderError(Exception):
     def __init__(self,cline):
         self.value = cline
     def __str__(self):
-        print('\n\nTable Block Header Error: \n' +
-              'Table header row contains errors on line: ' + str(self.value))
-        return 
+        return('\n\nTable Block Header Error: \n' +
+               'Table header row contains errors on line: ' + str(self.value))
 # -- wrong number of rows
 class TableBlockRowError(Exception):
     def __init__(self,blockname,nrow,nrowtrue):
@@ -1774,15 +4021,19 @@ class TableBlockRowError(Exception):
                str(self.nrowtrue) + ' rows found in block "' + self.blockname + '"')
 # -- wrong number of columns
 class TableBlockColError(Exception):
-    def __init__(self,blockname,cline,ncol,ncoltrue):
+    def __init__(self,blockname,cline,ncol,ncoltrue,cfile=None):
         self.blockname = blockname
         self.cline = cline
         self.ncol = ncol
         self.ncoltrue = ncoltrue
+        self.cfile = cfile
     def __str__(self):
+        where = 'line ' + str(self.cline)
+        if self.cfile is not None:
+            where += ' of ' + self.cfile
         return('\n\nTable Block Columns Error: \n' +
                'Table header indicates ' + str(self.ncol) + ' columns expected.\n' + 
-               str(self.ncoltrue) + ' columns found on line ' + str(self.cline) + ' of block "' + self.blockname + '"')
+               str(self.ncoltrue) + ' columns found on ' + where + ' of block "' + self.blockname + '"')
 # -- Table block is empty
 class TableBlockEmpty(Exception):
     def __init__(self,blockname,cline):
@@ -1856,21 +4107,141 @@ class ExternalFileOpenError(Exception):
         return('\n\nCannot open external file: ' + self.filename + ' for block: ' + self.blockname + '\n' ) 
 # -- no comments allowed in table blocks
 class TableCommentError(Exception):
-    def __init__(self,cline,cblock):
+    def __init__(self,cline,cblock,cfile=None):
         self.cline = cline
         self.cblock = cblock
+        self.cfile = cfile
     def __str__(self):
+        where = str(self.cline)
+        if self.cfile is not None:
+            where += ' of ' + self.cfile
         return('\n\nComments are not allowed in Table blocks.\nSee line ' + 
-               str(self.cline) + ' in block: ' + self.cblock + '\n')
+               where + ' in block: ' + self.cblock + '\n')
+# -- table cell of the wrong type
+class TableTypeError(Exception):
+    def __init__(self,cval,colname,cvaltype,cblock,crow,cline=None,cfile=None):
+        self.cval = cval
+        self.colname = colname
+        self.cvaltype = cvaltype
+        self.cblock = cblock
+        self.crow = crow
+        self.cline = cline
+        self.cfile = cfile
+    def __str__(self):
+        if self.cline is None:
+            where = 'entry ' + str(self.crow+1)
+        else:
+            where = 'line ' + str(self.cline+self.crow)
+        if self.cfile is not None:
+            where += ' of ' + self.cfile
+        return('\n\nTable Block type mismatch: \n' +
+               'Column ' + self.colname + ' should be of type: ' + self.cvaltype +
+               '\nThe value "' + str(self.cval) + '" was provided on ' + where +
+               ' of block: ' + self.cblock + '\n')
 # -- incorrect Input file extension
 class InvalidInputExtension(Exception):
     def __init__(self,filename):
         self.cfile = filename
     def __str__(self):
-        return('\n\nInvalid input filename: ' + self.cfile + '\nFile should be of format <casename>.kyp\n')
+        return('\n\nInvalid input filename: ' + self.cfile + '\nFile should be of format <casename>.kyp or <casename>.pst,\n' +
+               'optionally compressed as <casename>.kyp.gz, .bz2 or .xz\n')
 # -- mismatch of keywords and values in defaults file
 class DefaultKeyError(Exception):
     def __init__(self):
         self.cfile = 'key_defaults.txt'
     def __str__(self):
         return('\n\nMismatch between number of variable names and values in : ' + self.cfile + '\n')
+# -- snapshot file written by a different version, or not a snapshot at all
+class SnapshotVersionError(Exception):
+    def __init__(self,filename,version):
+        self.cfile = filename
+        self.version = version
+    def __str__(self):
+        return('\n\nSnapshot file ' + self.cfile + ' has version ' + str(self.version) +
+               ', expected version ' + str(SNAPSHOT_VERSION) + '\nRe-create it from the .kyp or XML file\n')
+# -- names used in a table block but not defined in the block they refer to
+class TableReferenceError(Exception):
+    def __init__(self,dangling):
+        # list of (block,column,name,defining block,defining column,location)
+        self.dangling = dangling
+    def __str__(self):
+        # one line per undefined name, giving where it was first used
+        first = dict()
+        counts = dict()
+        order = list()
+        for cref in self.dangling:
+            ckey = cref[:3]
+            if ckey not in first:
+                first[ckey] = cref
+                counts[ckey] = 0
+                order.append(ckey)
+            counts[ckey] += 1
+        msg = '\n\nUndefined names referenced in table blocks:\n'
+        for ckey in order:
+            name,colname,cval,target,tcolname,where = first[ckey]
+            msg += ('%s "%s" used on %s of block "%s" is not a %s in block "%s"' %
+                    (colname,cval,where,name,tcolname,target))
+            if counts[ckey] > 1:
+                msg += ' (%d uses)' % counts[ckey]
+            msg += '\n'
+        return msg
+# -- numeric table values that PEST would reject
+class TableValueError(Exception):
+    def __init__(self,report,blocks,nshow=10):
+        # report is a list of (block,check,rows) as returned by check_values
+        self.report = report
+        self.blocks = blocks
+        self.nshow = nshow
+    def __str__(self):
+        msg = '\n\nTable values out of range:\n'
+        for name,ccheck,rows in self.report:
+            cblock = self.blocks.get(name)
+            wheres = list()
+            for crow in rows[:self.nshow]:
+                if cblock is not None:
+                    wheres.append(cblock.row_location(crow))
+                else:
+                    wheres.append('entry ' + str(crow+1))
+            msg += ('%s in block "%s" on %d rows: %s' %
+                    (ccheck,name,len(rows),', '.join(wheres)))
+            if len(rows) > self.nshow:
+                msg += ', ...'
+            msg += '\n'
+        return msg
+# -- names used more than once in a table block
+class TableDuplicateError(Exception):
+    def __init__(self,dupes):
+        # list of (block,column,name,locations)
+        self.dupes = dupes
+    def __str__(self):
+        msg = '\n\nNames used more than once in table blocks:\n'
+        for name,colname,cval,wheres in self.dupes:
+            msg += ('%s "%s" in block "%s" on %s\n' %
+                    (colname,cval,name,', '.join(wheres)))
+        return msg
+# -- a PST file line that cannot be read
+class PstLineError(Exception):
+    def __init__(self,section,cline,problem):
+        self.section = section
+        self.cline = cline
+        self.problem = problem
+    def __str__(self):
+        return('\n\nPST File Error: \n' + self.problem + ' on line ' + str(self.cline) +
+               ' (section "' + self.section + '")')
+# -- a compressed file whose compression module is not installed
+class CompressionModuleError(Exception):
+    def __init__(self,filename,module):
+        self.cfile = filename
+        self.module = module
+    def __str__(self):
+        return('\n\nCannot open compressed file: ' + self.cfile + '\nThe ' + self.module +
+               ' module is needed (backports.lzma on Python 2)\n')
+# -- an external table saved as arrays that cannot be used
+class ArrayTableError(Exception):
+    def __init__(self,filename,blockname,problem):
+        self.cfile = filename
+        self.blockname = blockname
+        self.problem = problem
+    def __str__(self):
+        return('\n\nCannot read the arrays of external file: ' + self.cfile + ' for block: ' +
+               self.blockname + '\n' + self.problem + '\n')